@@ -0,0 +1,191 @@
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+import numpy as np
+
+# Answers for repeated or paraphrased questions, so they skip retrieval and the LLM call
+cache_path = os.path.join(os.getcwd(), "cache", "answers.json")
+DEFAULT_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+DEFAULT_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(24 * 3600)))
+DEFAULT_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "512"))
+# Changes are written to disk in the background at most this often, never on the request path
+DEFAULT_SAVE_INTERVAL = float(os.getenv("ANSWER_CACHE_SAVE_INTERVAL", "5"))
+
+def normalize_question(question):
+    return " ".join(question.lower().split())
+
+class AnswerCache:
+    '''
+    Semantic answer cache: exact matches on the normalized question, then cosine similarity of
+    question embeddings above `threshold`. Entries expire after `ttl` seconds, the least recently
+    used are evicted beyond `max_entries`, and everything is dropped when the index version changes.
+
+    Persisted as a small JSON file with the questions and answers, plus a float32 `.npy` matrix of
+    the question vectors named by the JSON, so each save replaces both consistently.
+    '''
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES, path=cache_path,
+                 save_interval=DEFAULT_SAVE_INTERVAL):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self.save_interval = save_interval
+        self.index_version = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._matrix = None
+        self._lock = threading.Lock()
+        # Serializes writers, so a timer save and an exit flush never interleave their files
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._timer = None
+
+    def set_index_version(self, index_version):
+        ''' Drop every cached answer when the index they were generated from is replaced '''
+        with self._lock:
+            if index_version != self.index_version:
+                self.index_version = index_version
+                self._entries.clear()
+                self._matrix = None
+                self._dirty = True
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        expired = [key for key, entry in self._entries.items() if entry['created'] < cutoff]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+    def get_exact(self, question):
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(normalize_question(question))
+            if entry is not None:
+                self._entries.move_to_end(normalize_question(question))
+                self.hits += 1
+            return entry
+
+    def get_similar(self, vector):
+        ''' Closest cached question whose similarity to `vector` reaches the threshold '''
+        with self._lock:
+            self._expire()
+            if not self._entries:
+                self.misses += 1
+                return None
+            if self._matrix is None:
+                self._keys = list(self._entries)
+                self._matrix = np.stack([self._entries[key]['vector'] for key in self._keys])
+            query = np.asarray(vector, dtype=np.float32)
+            scores = self._matrix @ (query / (np.linalg.norm(query) or 1.0))
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+            key = self._keys[best]
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, question, vector, answer, images, index_version=None):
+        ''' Cache an answer; answers generated from an index version that has since been replaced are dropped '''
+        if index_version is not None and index_version != self.index_version:
+            return
+        vector = np.asarray(vector, dtype=np.float32)
+        entry = {
+            'question': question,
+            'vector': vector / (np.linalg.norm(vector) or 1.0),
+            'answer': answer,
+            'images': list(images),
+            'created': time.time(),
+        }
+        with self._lock:
+            key = normalize_question(question)
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+            self._dirty = True
+        self._save_later()
+
+    def __contains__(self, question):
+        with self._lock:
+            return normalize_question(question) in self._entries
+
+    def _save_later(self):
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(self.save_interval, self._on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+        try:
+            self.save()
+        except OSError as e:
+            print(f"Could not persist the answer cache: {e}")
+
+    def flush(self):
+        ''' Write pending changes now, e.g. at shutdown '''
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        self.save()
+
+    def save(self):
+        ''' Persist the cache if it changed since the last save '''
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                self._dirty = False
+                entries = [{key: value for key, value in entry.items() if key != 'vector'} for entry in self._entries.values()]
+                vectors = [entry['vector'] for entry in self._entries.values()]
+                index_version = self.index_version
+            directory = os.path.dirname(self.path)
+            os.makedirs(directory, exist_ok=True)
+            stem = os.path.splitext(os.path.basename(self.path))[0]
+            vectors_name = f"{stem}-{uuid.uuid4().hex}.npy"
+            np.save(os.path.join(directory, vectors_name),
+                    np.stack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32))
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({'index_version': index_version, 'vectors': vectors_name, 'entries': entries}, f)
+            os.replace(tmp_path, self.path)
+            for old_path in glob.glob(os.path.join(directory, f"{stem}-*.npy")):
+                if os.path.basename(old_path) != vectors_name:
+                    os.remove(old_path)
+
+    def load(self):
+        ''' Restore persisted answers that belong to the current index version '''
+        try:
+            with open(self.path) as f:
+                payload = json.load(f)
+            # Files written before vectors moved out of the JSON have no vector matrix and are ignored
+            vectors = np.load(os.path.join(os.path.dirname(self.path), payload['vectors']))
+        except (OSError, ValueError, KeyError):
+            return
+        with self._lock:
+            entries = payload.get('entries', [])
+            if payload.get('index_version') != self.index_version or len(vectors) != len(entries):
+                return
+            for entry, vector in zip(entries, vectors):
+                self._entries[normalize_question(entry['question'])] = dict(entry, vector=vector)
+            self._expire()
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
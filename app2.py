@@ -1,32 +1,65 @@
+import asyncio
+import atexit
+import threading
+import time
 import chainlit as cl
-from langchain.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from langchain import hub
-from retriver import load_retriever_instance
+from chainlit.server import app as server_app
+from langchain_core.prompts import PromptTemplate
+from prompts import answer_template
+from retriver import current_index_version, load_retriever_instance, open_retriever
+from answer_cache import AnswerCache
+from context_builder import CONTEXT_CANDIDATES, build_context, load_encoding
+from embedding_batcher import QueryEmbeddingBatcher
+from blob_store import get_blob_store
+from governor import background_priority, estimate_tokens, get_governor
+from llms import MAX_COMPLETION_TOKENS, get_answer_llm, get_embeddings
+from telemetry import mount_metrics_endpoint, observe, span, timed
 from dotenv import load_dotenv
-from PIL import Image
-import io
-import base64
 
 # Load environment variables
 load_dotenv()
 
-# Pull the prompt template from the hub
-rag_prompt_mistral = hub.pull("rlm/rag-prompt-mistral")
+# The retriever, query embeddings and answer cache are opened on first use, so importing this module stays cheap
+retriever_instance = None
+embeddings = None
+query_embedder = None
+answer_cache = AnswerCache()
+# Answers added since the last background save are written at shutdown
+atexit.register(answer_cache.flush)
+loaded_index_version = None
+warm_task = None
+warmed_index_version = None
+tokenizer_task = None
+_load_lock = threading.Lock()
 
-# Load the retriever instance
-retriever_instance = load_retriever_instance()
+def get_retriever():
+    global retriever_instance, embeddings, query_embedder, loaded_index_version
+    with _load_lock:
+        if retriever_instance is None:
+            retriever_instance = load_retriever_instance()
+            embeddings = get_embeddings()
+            # Concurrent sessions share one embedding request per few milliseconds of questions
+            query_embedder = QueryEmbeddingBatcher(embeddings)
+            # Restore the cached answers that belong to the index just opened
+            loaded_index_version = current_index_version()
+            answer_cache.set_index_version(loaded_index_version)
+            answer_cache.load()
+        elif current_index_version() != loaded_index_version:
+            # Ingestion published a new index: reopen it before any answer is cached for the new version
+            index_version = current_index_version()
+            retriever_instance = open_retriever()
+            loaded_index_version = index_version
+            answer_cache.set_index_version(loaded_index_version)
+    return retriever_instance
 
-# Function to load the model
+# Prometheus-style stage timings and LLM usage counters at /metrics
+mount_metrics_endpoint(server_app)
+
+# Function to load the shared, connection-pooled answer model
 def load_model():
-    return ChatOpenAI(temperature=0, model="gpt-4-vision-preview", max_tokens=1024)
+    return get_answer_llm()
 
 # Prompt template for the answer chain
-answer_template = """
-Answer the question based only on the following context, which can include text, images, and tables:
-{context}
-Question: {question} 
-"""
 answer_prompt = PromptTemplate.from_template(answer_template)
 
 # Predefined questions
@@ -59,38 +92,117 @@ predefined_questions = [
     "Generate a detailed explanation of the measurement ranges and accuracy for moisture, SF6 volume percentage, and SO2 concentration.",
     "Describe the calibration requirements and intervals for the MIRROR-ANALYSER SF6.",
     "Compare the different models of the MIRROR-ANALYSER SF6 (e.g., 3-035R-R301, 3-035R-R302, 3-035R-R303).",
-    "List the available accessories for increasing pressure in medium voltage switchgear and explain their use with the MIRROR-ANALYSER SF6.",
-    "What kind of electronic device is housed inside the rugged carrying case, and what are its functions?"
+    "List the available accessories for increasing pressure in medium voltage switchgear and explain their use with the MIRROR-ANALYSER SF6."
 ]
 
+# Function to retrieve the context and the images for a question
+@timed("answer.retrieve")
+async def retrieve(question, vector=None):
+    retriever = await asyncio.to_thread(get_retriever)
+    if vector is None:
+        vector = await query_embedder.aembed_query(question)
+    relevant_docs = await asyncio.to_thread(
+        retriever.similarity_search_with_vector, question, vector, CONTEXT_CANDIDATES)
+    with span("answer.build_context"):
+        # Reranked, de-overlapped and packed into the token budget; only images that made it in are shown
+        context, relevant_images = await asyncio.to_thread(
+            build_context, question, relevant_docs, retriever.lexical_index)
+    return context, relevant_images
+
+# Function to stream the answer tokens for a retrieved context
+async def stream_answer(context, question):
+    chain = answer_prompt | load_model()
+    start = time.perf_counter()
+    first_token = True
+    # Chat sessions are interactive, so they are admitted ahead of any ingestion running in the process
+    tokens = estimate_tokens(answer_template + context + question, MAX_COMPLETION_TOKENS)
+    async with get_governor().aslot(tokens):
+        async for chunk in chain.astream({'context': context, 'question': question}):
+            if chunk.content:
+                if first_token:
+                    observe("answer.first_token", time.perf_counter() - start)
+                    first_token = False
+                yield chunk.content
+    observe("answer.generate", time.perf_counter() - start)
+
 # Function to process the question and get the answer
 async def answer(question):
-    relevant_docs = retriever_instance.similarity_search(question)
-    context = ""
-    relevant_images = []
-    for d in relevant_docs:
-        if d.metadata['type'] == 'text':
-            context += '[text]' + d.metadata['original_content']
-        elif d.metadata['type'] == 'table':
-            context += '[table]' + d.metadata['original_content']
-        elif d.metadata['type'] == 'image':
-            context += '[image]' + d.page_content
-            relevant_images.append(d.metadata['original_content'])
-    
-    chain = answer_prompt | load_model()
-    result = await chain.ainvoke({'context': context, 'question': question})
-    return result.content, relevant_images
+    context, relevant_images = await retrieve(question)
+    tokens = [token async for token in stream_answer(context, question)]
+    return "".join(tokens), relevant_images
+
+# Function to look up a cached answer for the question or a close paraphrase of it
+@timed("answer.cache_lookup")
+async def lookup_answer(question):
+    await asyncio.to_thread(get_retriever)
+    entry = answer_cache.get_exact(question)
+    vector = None
+    if entry is None:
+        vector = await query_embedder.aembed_query(question)
+        entry = answer_cache.get_similar(vector)
+    return entry, vector
+
+# Function to answer through the cache, storing fresh answers in it
+async def cached_answer(question):
+    entry, vector = await lookup_answer(question)
+    if entry is not None:
+        return entry['answer'], entry['images']
+    index_version = loaded_index_version
+    text_answer, image_hashes = await answer(question)
+    if vector is None:
+        vector = await query_embedder.aembed_query(question)
+    answer_cache.put(question, vector, text_answer, image_hashes, index_version)
+    return text_answer, image_hashes
 
-# Function to decode base64 image strings and get image data
-def get_image_data(base64_string):
-    image_data = base64.b64decode(base64_string)
-    image = Image.open(io.BytesIO(image_data))
-    buffered = io.BytesIO()
-    image.save(buffered, format="PNG")
-    return buffered.getvalue()
+# Function to precompute the answers of the predefined questions for the current index
+async def warm_answer_cache():
+    # Precomputed answers queue behind live chat sessions for model capacity
+    with background_priority():
+        for question in predefined_questions:
+            if question in answer_cache:
+                continue
+            try:
+                await cached_answer(question)
+            except Exception as e:
+                print(f"Could not precompute the answer to {question!r}: {e}")
+
+def ensure_answer_cache_warm():
+    global warm_task, warmed_index_version
+    # Called after get_retriever, so this is the version the retriever and the cache are on
+    index_version = loaded_index_version
+    if (warm_task is None or warm_task.done()) and warmed_index_version != index_version:
+        warmed_index_version = index_version
+        warm_task = asyncio.create_task(warm_answer_cache())
+
+def ensure_tokenizer_loaded():
+    global tokenizer_task
+    # The vocabulary may have to be downloaded, so it loads in a thread; token counts are estimated until then
+    if tokenizer_task is None:
+        tokenizer_task = asyncio.create_task(asyncio.to_thread(load_encoding))
+
+# Function to get the display-ready PNG precomputed at ingest time
+@timed("answer.image_data")
+def get_image_data(image_hash):
+    return get_blob_store().get(image_hash, 'display')
+
+# Function to build the image elements for a list of image hashes
+async def image_elements(image_hashes):
+    image_data_list = await asyncio.to_thread(lambda: [get_image_data(h) for h in image_hashes])
+    return [
+        cl.Image(name=f"image_{idx+1}", content=image_data, display="inline")
+        for idx, image_data in enumerate(image_data_list)
+    ]
+
+# Function to attach the retrieved images to a message while the answer is still streaming
+async def attach_images(msg, image_hashes):
+    elements = await image_elements(image_hashes)
+    await asyncio.gather(*(element.send(for_id=msg.id) for element in elements))
 
 @cl.on_chat_start
 async def start():
+    ensure_tokenizer_loaded()
+    await asyncio.to_thread(get_retriever)
+    ensure_answer_cache_warm()
     await cl.Message(content="Welcome to DILO-CHATBOT Assistant! 🚀🤖\n\nHi there! 👋 I'm here to help you with information about our high-pressure application valve system and the MIRROR-ANALYSER SF6. You can choose from predefined questions or ask your own.").send()
     
     actions = [
@@ -109,6 +221,7 @@ async def on_custom(action):
     await cl.AskUserMessage(content="Please enter your question:").send()
 
 @cl.on_message
+@timed("chat.message")
 async def main(message: cl.Message):
     question = message.content
     try:
@@ -118,24 +231,26 @@ async def main(message: cl.Message):
     except ValueError:
         pass  # If not a number, treat as a custom question
 
-    # Send a temporary message to show that we're processing
-    msg = cl.Message(content="Thinking...")
-    await msg.send()
-
-    # Get the answer and relevant images
-    text_answer, image_data_list = await answer(question)
+    entry, vector = await lookup_answer(question)
+    index_version = loaded_index_version
+    if entry is not None:
+        # Repeated or paraphrased question: answer straight from the cache
+        await cl.Message(content=entry['answer'], elements=await image_elements(entry['images'])).send()
+    else:
+        # Create the answer message up front so images and tokens can be attached to it as they arrive
+        msg = cl.Message(content="")
+        await msg.send()
 
-    # Prepare the images
-    elements = []
-    for idx, img_data in enumerate(image_data_list):
-        image_data = get_image_data(img_data)
-        elements.append(cl.Image(name=f"image_{idx+1}", content=image_data, display="inline"))
+        # The vector computed for the cache lookup is reused for the vector search
+        context, image_hashes = await retrieve(question, vector)
+        images_task = asyncio.create_task(attach_images(msg, image_hashes))
 
-    # Send the answer with images
-    await cl.Message(content=text_answer, elements=elements).send()
+        async for token in stream_answer(context, question):
+            await msg.stream_token(token)
 
-    # Remove the temporary message
-    await msg.remove()
+        await images_task
+        await msg.update()
+        answer_cache.put(question, vector, msg.content, image_hashes, index_version)
 
     # Ask if the user wants to ask another question
     actions = [
@@ -0,0 +1,82 @@
+import asyncio
+import os
+import time
+import zlib
+from typing import Any, List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from lexical_index import tokenize
+
+def message_text(messages):
+    ''' Concatenated text parts of a list of chat messages, ignoring image parts '''
+    parts = []
+    for message in messages:
+        if isinstance(message.content, str):
+            parts.append(message.content)
+        else:
+            parts.extend(part.get('text', '') for part in message.content if isinstance(part, dict))
+    return " ".join(parts)
+
+class FakeChatModel(BaseChatModel):
+    '''
+    Deterministic stand-in for the OpenAI chat model. The reply echoes the last `words` words of
+    the prompt, so summaries stay related to their input, and `latency` simulates the API round trip.
+    '''
+
+    model_name: str = "fake-chat"
+    words: int = 40
+    latency: float = float(os.getenv("RAG_FAKE_LLM_LATENCY", "0"))
+
+    @property
+    def _llm_type(self):
+        return "fake-chat"
+
+    def _reply(self, messages):
+        return " ".join(message_text(messages).split()[-self.words:])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs: Any):
+        if self.latency:
+            time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._reply(messages)))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs: Any):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._reply(messages)))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs: Any):
+        if self.latency:
+            time.sleep(self.latency)
+        for word in self._reply(messages).split():
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word + " "))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs: Any):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        for word in self._reply(messages).split():
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word + " "))
+
+class HashingEmbeddings(Embeddings):
+    ''' Deterministic bag-of-words embeddings: each term is hashed into one of `size` signed buckets '''
+
+    def __init__(self, size=256):
+        self.size = size
+
+    def _embed(self, text):
+        vector = np.zeros(self.size, dtype=np.float32)
+        for term in tokenize(text):
+            bucket = zlib.crc32(term.encode('utf-8'))
+            vector[bucket % self.size] += 1.0 if bucket & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
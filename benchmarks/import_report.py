@@ -0,0 +1,66 @@
+"""
+Import-time report for the serving and ingestion modules, based on `python -X importtime`.
+
+    python -m benchmarks.import_report app2 retriver image_processing
+"""
+import json
+import os
+import subprocess
+import sys
+
+SERVING_MODULES = ('app2', 'retriver', 'image_processing', 'ingest')
+
+def parse_importtime(stderr):
+    ''' `(name, depth, self_us, cumulative_us)` rows from `-X importtime` output, in print order '''
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        # One space after the separator, then two more per nesting level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return rows
+
+def import_report(module, top=10, cwd=None, env=None):
+    '''
+    Cold-import cost of `module` in a fresh interpreter: its cumulative import time, the direct
+    imports that dominate it, and the modules with the largest self time.
+    '''
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=cwd, env=env, capture_output=True, text=True,
+    )
+    if completed.returncode != 0:
+        return {'error': completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'failed'}
+    rows = parse_importtime(completed.stderr)
+
+    # Children are printed before their parent, so the direct imports of `module` are the
+    # shallowest rows between the previous top-level import and `module` itself
+    end = max(i for i, row in enumerate(rows) if row[0] == module and row[1] == 0)
+    start = end
+    while start > 0 and rows[start - 1][1] > 0:
+        start -= 1
+    children = [row for row in rows[start:end] if row[1] == 1]
+
+    return {
+        'cumulative_ms': rows[end][3] / 1000,
+        'modules_imported': end - start + 1,
+        'heaviest_imports': [
+            {'module': name, 'cumulative_ms': cumulative / 1000}
+            for name, _, _, cumulative in sorted(children, key=lambda row: row[3], reverse=True)[:top]
+        ],
+        'slowest_self': [
+            {'module': name, 'self_ms': self_us / 1000}
+            for name, _, self_us, _ in sorted(rows[start:end + 1], key=lambda row: row[2], reverse=True)[:top]
+        ],
+    }
+
+def main():
+    modules = sys.argv[1:] or list(SERVING_MODULES)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        filter(None, [os.path.dirname(os.path.dirname(os.path.abspath(__file__))), os.environ.get('PYTHONPATH')])))
+    print(json.dumps({module: import_report(module, env=env) for module in modules}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+Offline benchmark harness for ingestion and query latency.
+
+Every phase runs in its own subprocess, inside a scratch working directory holding a copy of the
+data, with `RAG_FAKE_MODELS=1` so the chat and embedding models are the deterministic local
+stand-ins from `benchmarks.fake_models` and no network access is needed. Prompts are bundled in
+`prompts.py`. Results are written as JSON.
+
+    python -m benchmarks.run --output bench_output.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PHASES = ('imports', 'ingest', 'startup', 'query')
+
+def percentiles(samples):
+    ''' Latency summary in milliseconds '''
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def at(fraction):
+        return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))] * 1000
+
+    return {
+        'count': len(ordered),
+        'mean_ms': sum(ordered) / len(ordered) * 1000,
+        'p50_ms': at(0.50),
+        'p90_ms': at(0.90),
+        'p99_ms': at(0.99),
+        'max_ms': ordered[-1] * 1000,
+    }
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def count_pages(data_path):
+    from pypdf import PdfReader
+
+    pages = 0
+    for name in os.listdir(data_path):
+        if name.endswith('.pdf'):
+            pages += len(PdfReader(os.path.join(data_path, name)).pages)
+    return pages
+
+def run_ingest_phase(args):
+    import ingest
+    import retriver
+
+    pages = count_pages(retriver.path)
+    start = time.perf_counter()
+    ingest.run_ingestion(retriver.path, rebuild=True, max_workers=args.workers)
+    elapsed = time.perf_counter() - start
+
+    manifest = retriver.load_manifest()
+    elements = sum(len(entry['ids']) for entry in manifest['sources'].values())
+
+    # A second run over unchanged data measures the cost of the incremental no-op path
+    start = time.perf_counter()
+    ingest.run_ingestion(retriver.path, max_workers=args.workers)
+    noop = time.perf_counter() - start
+
+    return {
+        'seconds': elapsed,
+        'pages': pages,
+        'elements': elements,
+        'pages_per_second': pages / elapsed if elapsed else None,
+        'elements_per_second': elements / elapsed if elapsed else None,
+        'noop_reingest_seconds': noop,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def run_imports_phase(args):
+    from benchmarks.import_report import SERVING_MODULES, import_report
+
+    return {module: import_report(module) for module in SERVING_MODULES}
+
+def run_startup_phase(args):
+    start = time.perf_counter()
+    import app2
+    app_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    app2.get_retriever()
+    load_seconds = time.perf_counter() - start
+
+    return {
+        'import_app_seconds': app_seconds,
+        'load_retriever_seconds': load_seconds,
+        'total_seconds': app_seconds + load_seconds,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def run_query_phase(args):
+    import app2
+    import telemetry
+
+    questions = app2.predefined_questions
+    retriever = app2.get_retriever()
+
+    search_samples = []
+    for _ in range(args.repeats):
+        for question in questions:
+            start = time.perf_counter()
+            retriever.similarity_search(question)
+            search_samples.append(time.perf_counter() - start)
+
+    async def answer_all():
+        samples = []
+        for _ in range(args.repeats):
+            for question in questions:
+                start = time.perf_counter()
+                await app2.answer(question)
+                samples.append(time.perf_counter() - start)
+        return samples
+
+    answer_samples = asyncio.run(answer_all())
+    counters = {c['name']: c['value'] for c in telemetry.snapshot()['counters'] if not c['labels']}
+    return {
+        'questions': len(questions),
+        'similarity_search': percentiles(search_samples),
+        'answer': percentiles(answer_samples),
+        'context_tokens_per_answer': counters.get('context_tokens_total', 0) / len(answer_samples),
+        'context_tokens_saved_per_answer': counters.get('context_tokens_saved_total', 0) / len(answer_samples),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def run_phase(args):
+    ''' Child process entry point: run one phase in the current directory and write its result '''
+    runner = {
+        'imports': run_imports_phase,
+        'ingest': run_ingest_phase,
+        'startup': run_startup_phase,
+        'query': run_query_phase,
+    }[args.phase]
+    result = runner(args)
+    with open(args.result_file, "w") as f:
+        json.dump(result, f)
+
+def spawn_phase(phase, workdir, args):
+    result_file = os.path.join(workdir, f"{phase}.json")
+    env = dict(os.environ, RAG_FAKE_MODELS="1", RAG_FAKE_LLM_LATENCY=str(args.llm_latency),
+               PYTHONPATH=os.pathsep.join(filter(None, [repo_root, os.environ.get('PYTHONPATH')])))
+    command = [sys.executable, "-m", "benchmarks.run", "--phase", phase, "--result-file", result_file,
+               "--repeats", str(args.repeats), "--workers", str(args.workers)]
+    completed = subprocess.run(command, cwd=workdir, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        return {'error': completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'failed',
+                'returncode': completed.returncode}
+    with open(result_file) as f:
+        return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline ingestion and query benchmarks with fake models.")
+    parser.add_argument("--data", default=os.path.join(repo_root, "Data"), help="Corpus to ingest")
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout")
+    parser.add_argument("--phases", default=",".join(PHASES), help="Comma-separated subset of: " + ", ".join(PHASES))
+    parser.add_argument("--repeats", type=int, default=3, help="Passes over the predefined questions")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="PDF partitioning processes")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Simulated seconds per fake LLM call")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch working directory")
+    parser.add_argument("--phase", choices=PHASES, help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.phase:
+        run_phase(args)
+        return
+
+    workdir = tempfile.mkdtemp(prefix="rag-bench-")
+    # Ingestion extracts figures into the data directory, so always work on a copy
+    shutil.copytree(args.data, os.path.join(workdir, "Data"))
+    results = {
+        'python': sys.version.split()[0],
+        'cpu_count': os.cpu_count(),
+        'workers': args.workers,
+        'llm_latency_seconds': args.llm_latency,
+        'repeats': args.repeats,
+    }
+    try:
+        for phase in args.phases.split(","):
+            results[phase] = spawn_phase(phase, workdir, args)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
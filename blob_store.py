@@ -0,0 +1,84 @@
+import hashlib
+import io
+import os
+import shutil
+from PIL import Image
+
+# Content-addressed image store: images live on disk once, vector metadata only holds the hash
+blob_directory = os.path.join(os.getcwd(), "blob_store")
+THUMBNAIL_SIZE = (256, 256)
+
+# Renditions precomputed at ingest time so serving never re-encodes images
+RENDITIONS = {
+    'original': 'original.jpg',
+    'display': 'display.png',
+    'thumbnail': 'thumbnail.webp',
+}
+
+class BlobStore:
+    def __init__(self, root=blob_directory):
+        self.root = root
+
+    def _directory(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def path(self, digest, rendition='display'):
+        return os.path.join(self._directory(digest), RENDITIONS[rendition])
+
+    def has(self, digest):
+        return all(os.path.exists(self.path(digest, rendition)) for rendition in RENDITIONS)
+
+    def get(self, digest, rendition='display'):
+        with open(self.path(digest, rendition), "rb") as f:
+            return f.read()
+
+    def add_image(self, data):
+        ''' Store the image bytes and their display renditions, returning the content hash '''
+        digest = hashlib.sha256(data).hexdigest()
+        if self.has(digest):
+            return digest
+
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        if image.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+            image = image.convert("RGB")
+        display = io.BytesIO()
+        image.save(display, format="PNG")
+        thumbnail = image.convert("RGB")
+        thumbnail.thumbnail(THUMBNAIL_SIZE)
+        thumb = io.BytesIO()
+        thumbnail.save(thumb, format="WEBP", quality=80)
+
+        os.makedirs(self._directory(digest), exist_ok=True)
+        for rendition, content in (('original', data), ('display', display.getvalue()), ('thumbnail', thumb.getvalue())):
+            self._write(self.path(digest, rendition), content)
+        return digest
+
+    def _write(self, file_path, content):
+        # Write-then-rename so concurrent readers never see a partial file
+        tmp_path = file_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, file_path)
+
+    def prune(self, keep):
+        ''' Delete every stored image whose hash is not in `keep`, returning how many were removed '''
+        removed = 0
+        if not os.path.isdir(self.root):
+            return removed
+        for prefix in os.listdir(self.root):
+            prefix_directory = os.path.join(self.root, prefix)
+            for digest in os.listdir(prefix_directory):
+                if digest not in keep:
+                    shutil.rmtree(os.path.join(prefix_directory, digest), ignore_errors=True)
+                    removed += 1
+        return removed
+
+_blob_store = None
+
+def get_blob_store():
+    ''' Process-wide blob store '''
+    global _blob_store
+    if _blob_store is None:
+        _blob_store = BlobStore()
+    return _blob_store
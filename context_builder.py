@@ -0,0 +1,166 @@
+import math
+import os
+import threading
+from collections import Counter
+
+from dedup import shingles
+from lexical_index import tokenize
+from telemetry import incr
+
+# Size of the context passed to the answer model, and the most any single table may take of it
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2500"))
+CONTEXT_TABLE_TOKENS = int(os.getenv("CONTEXT_TABLE_TOKENS", "600"))
+# Documents retrieved as candidates for the context
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", "4"))
+# A chunk is dropped when this share of its shingles already appears in a higher-ranked chunk
+CONTEXT_OVERLAP_THRESHOLD = float(os.getenv("CONTEXT_OVERLAP_THRESHOLD", "0.8"))
+# Weight of the retrieval rank next to the lexical overlap score
+RANK_WEIGHT = 0.25
+# Text chunks are only cut to fit the remaining budget if at least this much of it is left
+MIN_PARTIAL_TOKENS = 100
+
+# None until `load_encoding` ran, False when tiktoken or its vocabulary is unavailable
+_encoding = None
+_encoding_lock = threading.Lock()
+
+def load_encoding():
+    '''
+    Load the answer model's tokenizer. tiktoken downloads the vocabulary on first use, so this runs
+    off the request path, e.g. from a thread at startup.
+    '''
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception:
+                _encoding = False
+    return _encoding
+
+def _get_encoding():
+    ''' The tokenizer once `load_encoding` finished; never loads it, so counting never waits on the network '''
+    return _encoding
+
+def count_tokens(text):
+    ''' Exact count with tiktoken, else about four characters per token '''
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // 4
+
+def truncate_to_tokens(text, max_tokens):
+    ''' Leading part of the text that fits in `max_tokens`, cut at a word boundary '''
+    encoding = _get_encoding()
+    # Two tokens are left for the ellipsis
+    if encoding:
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        text = encoding.decode(tokens[:max_tokens - 2])
+    elif len(text) // 4 <= max_tokens:
+        return text
+    else:
+        text = text[:(max_tokens - 2) * 4]
+    return text.rsplit(" ", 1)[0] + " ..."
+
+def truncate_table(table, max_tokens, query_terms):
+    '''
+    Shrink a table to `max_tokens`: keep the header line, then the rows that best match the query
+    terms, then the remaining rows in order, and note how many rows were left out. Rows are stored
+    one per line (see `retriver.table_text`); a term weighs more the fewer rows contain it, so units
+    or model prefixes shared by every row don't count.
+    '''
+    if count_tokens(table) <= max_tokens:
+        return table
+    lines = [line for line in table.splitlines() if line.strip()]
+    if len(lines) < 3:
+        return truncate_to_tokens(table, max_tokens)
+
+    header, rows = lines[0], lines[1:]
+    row_terms = [query_terms & set(tokenize(row)) for row in rows]
+    frequency = Counter(term for terms in row_terms for term in terms)
+    weights = {term: math.log(len(rows) / count) for term, count in frequency.items()}
+    scores = [sum(weights[term] for term in terms) for terms in row_terms]
+    ordered = sorted(range(len(rows)), key=lambda i: (-scores[i], i))
+    kept = set()
+    # Room for the note on omitted rows
+    used = count_tokens(header) + 8
+    for i in ordered:
+        row_tokens = count_tokens(rows[i]) + 1
+        if used + row_tokens > max_tokens:
+            continue
+        kept.add(i)
+        used += row_tokens
+    omitted = len(rows) - len(kept)
+    return "\n".join([header] + [rows[i] for i in sorted(kept)] + ([f"[... {omitted} rows omitted]"] if omitted else []))
+
+def document_text(doc):
+    ''' What goes into the context for a retrieved document: the original element, or the image summary '''
+    if doc.metadata['type'] in ('text', 'table'):
+        return doc.metadata['original_content']
+    return doc.page_content
+
+def score_documents(question, docs, lexical_index=None):
+    '''
+    Cheap local reranking: the idf-weighted share of the question's terms found in each document,
+    plus a small bonus for a high retrieval rank. Returns `(score, rank, doc)` best first.
+    '''
+    idf = lexical_index.idf if lexical_index is not None else {}
+    query_terms = set(tokenize(question))
+    total = sum(idf.get(term, 1.0) for term in query_terms) or 1.0
+    scored = []
+    for rank, doc in enumerate(docs):
+        doc_terms = set(tokenize(document_text(doc)))
+        coverage = sum(idf.get(term, 1.0) for term in query_terms & doc_terms) / total
+        scored.append((coverage + RANK_WEIGHT / (1 + rank), rank, doc))
+    return sorted(scored, key=lambda item: (-item[0], item[1]))
+
+def build_context(question, docs, lexical_index=None, budget=CONTEXT_TOKEN_BUDGET, table_tokens=CONTEXT_TABLE_TOKENS):
+    '''
+    Rerank the retrieved documents, drop chunks that overlap a better one, shrink long tables and
+    pack the rest, best first, into `budget` tokens.
+
+    Returns:
+        tuple: `(context, image_hashes)` for the documents that made it into the context.
+    '''
+    query_terms = set(tokenize(question))
+    kept_shingles = []
+    parts = []
+    image_hashes = []
+    used = 0
+    original = 0
+    for _, _, doc in score_documents(question, docs, lexical_index):
+        kind = doc.metadata['type']
+        text = document_text(doc)
+        tokens = count_tokens(text)
+        original += tokens
+
+        doc_shingles = shingles(text)
+        if any(len(doc_shingles & other) >= CONTEXT_OVERLAP_THRESHOLD * len(doc_shingles) for other in kept_shingles):
+            incr("context_documents_dropped_total", reason="overlap")
+            continue
+
+        limit = budget - used
+        if kind == 'table':
+            limit = min(limit, table_tokens)
+        if tokens > limit:
+            # Image summaries are short and only useful whole; tiny leftovers are not worth a partial chunk
+            if kind == 'image' or limit < MIN_PARTIAL_TOKENS:
+                incr("context_documents_dropped_total", reason="budget")
+                continue
+            text = truncate_table(text, limit, query_terms) if kind == 'table' else truncate_to_tokens(text, limit)
+            tokens = count_tokens(text)
+            if tokens > limit:
+                incr("context_documents_dropped_total", reason="budget")
+                continue
+
+        kept_shingles.append(doc_shingles)
+        parts.append(f"[{kind}]{text}")
+        used += tokens
+        if kind == 'image':
+            image_hashes.append(doc.metadata['image_hash'])
+
+    incr("context_tokens_total", used)
+    incr("context_tokens_saved_total", original - used)
+    return "".join(parts), image_hashes
@@ -0,0 +1,217 @@
+import hashlib
+import json
+import os
+import threading
+import zlib
+
+import numpy as np
+
+from lexical_index import tokenize
+from telemetry import incr
+
+# Near-duplicate detection for text and table elements (MinHash over word shingles) and images
+# (difference hash). DEDUP=0 turns it off and keeps every element.
+DEDUP_ENABLED = os.getenv("DEDUP", "1") != "0"
+DEDUP_TEXT_THRESHOLD = float(os.getenv("DEDUP_TEXT_THRESHOLD", "0.9"))
+DEDUP_IMAGE_MAX_DISTANCE = int(os.getenv("DEDUP_IMAGE_MAX_DISTANCE", "4"))
+
+SHINGLE_SIZE = 5
+NUM_PERMUTATIONS = 64
+BANDS = 16
+ROWS = NUM_PERMUTATIONS // BANDS
+# A 64-bit dHash split into 8 bands: hashes within 7 bits of each other share at least one band
+IMAGE_BANDS = 8
+
+# Fixed seed, so signatures stay comparable across runs and with the saved index
+_random = np.random.RandomState(20240601)
+_multipliers = _random.randint(1, 2 ** 63 - 1, NUM_PERMUTATIONS, dtype=np.uint64) | np.uint64(1)
+_offsets = _random.randint(0, 2 ** 63 - 1, NUM_PERMUTATIONS, dtype=np.uint64)
+
+def shingles(text, size=SHINGLE_SIZE):
+    ''' Hashes of the overlapping `size`-word windows of the text '''
+    words = text.lower().split()
+    if len(words) <= size:
+        return {zlib.crc32(" ".join(words).encode())}
+    return {zlib.crc32(" ".join(words[i:i + size]).encode()) for i in range(len(words) - size + 1)}
+
+def minhash(text):
+    ''' MinHash signature using multiply-shift hashing, one row per permutation '''
+    values = np.fromiter(shingles(text), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        hashed = (np.outer(_multipliers, values) + _offsets[:, None]) >> np.uint64(32)
+    return hashed.min(axis=1).tolist()
+
+def value_digest(text):
+    '''
+    Digest of the terms that carry digits (part numbers, measurements). Spec tables for different
+    models are usually near-identical text, so elements only collapse when these agree exactly.
+    '''
+    terms = sorted({term for term in tokenize(text) if any(c.isdigit() for c in term)})
+    return hashlib.sha1("\n".join(terms).encode()).hexdigest()[:16]
+
+def text_signature(text):
+    return {'minhash': minhash(text), 'values': value_digest(text)}
+
+def dhash(image_path, size=8):
+    ''' 64-bit difference hash: brightness gradients of a 9x8 grayscale thumbnail '''
+    from PIL import Image
+
+    with Image.open(image_path) as img:
+        pixels = np.asarray(img.convert("L").resize((size + 1, size), Image.Resampling.LANCZOS), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int("".join('1' if bit else '0' for bit in bits), 2)
+
+def image_signature(image_path):
+    return {'dhash': dhash(image_path)}
+
+def similarity(a, b):
+    ''' Estimated Jaccard similarity of two MinHash signatures '''
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+class NearDuplicateIndex:
+    '''
+    Signatures of the canonical elements in the index, keyed by `source:kind:position`, with LSH
+    buckets for candidate lookup. Each canonical entry records the vector ID of its document and the
+    other sources whose copies were collapsed into it; `changed` holds the keys whose duplicate
+    sources changed since the index was loaded. Ingestion collapses on one thread while the index writer checkpoints the
+    entries on another, so both go through a lock.
+    '''
+
+    def __init__(self, enabled=DEDUP_ENABLED, text_threshold=DEDUP_TEXT_THRESHOLD,
+                 image_max_distance=DEDUP_IMAGE_MAX_DISTANCE):
+        self.enabled = enabled
+        self.text_threshold = text_threshold
+        self.image_max_distance = image_max_distance
+        self.entries = {}
+        self._buckets = {}
+        self.changed = set()
+        self._lock = threading.Lock()
+
+    def _bands(self, kind, signature):
+        if 'dhash' in signature:
+            width = 64 // IMAGE_BANDS
+            return [(kind, band, (signature['dhash'] >> (band * width)) & ((1 << width) - 1))
+                    for band in range(IMAGE_BANDS)]
+        return [(kind, band, tuple(signature['minhash'][band * ROWS:(band + 1) * ROWS])) for band in range(BANDS)]
+
+    def _matches(self, signature, other):
+        if 'dhash' in signature:
+            return hamming(signature['dhash'], other['dhash']) <= self.image_max_distance
+        return (signature['values'] == other['values']
+                and similarity(signature['minhash'], other['minhash']) >= self.text_threshold)
+
+    def add(self, key, kind, source, signature, duplicates=(), doc_id=None):
+        self.entries[key] = {'kind': kind, 'source': source, 'signature': signature,
+                             'duplicates': set(duplicates), 'id': doc_id}
+        for band in self._bands(kind, signature):
+            self._buckets.setdefault(band, []).append(key)
+
+    def find(self, kind, signature):
+        ''' Key of a canonical element the signature is a near-duplicate of, or None '''
+        seen = set()
+        for band in self._bands(kind, signature):
+            for key in self._buckets.get(band, ()):
+                if key not in seen:
+                    seen.add(key)
+                    if self._matches(signature, self.entries[key]['signature']):
+                        return key
+        return None
+
+    def collapse(self, kind, source, items, signature_of):
+        '''
+        Drop the items of one source that near-duplicate an element already in the index or an
+        earlier item of the same source, registering the rest as canonical.
+
+        Returns:
+            tuple: `(kept items, other sources the dropped items were collapsed into)`.
+        '''
+        if not self.enabled:
+            return list(items), []
+        kept = []
+        collapsed_into = set()
+        for item in items:
+            signature = signature_of(item)
+            with self._lock:
+                match = self.find(kind, signature)
+                if match is not None:
+                    canonical = self.entries[match]
+                    if canonical['source'] != source and source not in canonical['duplicates']:
+                        canonical['duplicates'].add(source)
+                        self.changed.add(match)
+                        collapsed_into.add(canonical['source'])
+                    incr("dedup_collapsed_total", kind=kind)
+                    continue
+                self.add(f"{source}:{kind}:{len(kept)}", kind, source, signature)
+            kept.append(item)
+        return kept, sorted(collapsed_into)
+
+    def assign_ids(self, source, kind, ids):
+        ''' Record the vector IDs of the items `collapse` kept for one source, in the order it kept them '''
+        with self._lock:
+            for position, doc_id in enumerate(ids):
+                entry = self.entries.get(f"{source}:{kind}:{position}")
+                if entry is not None:
+                    entry['id'] = doc_id
+
+    def duplicate_sources(self, keys, sources):
+        ''' `{vector ID: sorted duplicate sources within `sources`}` of the canonical elements under `keys` '''
+        with self._lock:
+            return {self.entries[key]['id']: sorted(self.entries[key]['duplicates'] & sources)
+                    for key in keys if key in self.entries and self.entries[key]['id'] is not None}
+
+    def discard(self, sources):
+        ''' Forget the elements of re-ingested or removed sources, and any references to them '''
+        sources = set(sources)
+        with self._lock:
+            entries = self.entries
+            self.entries = {}
+            self._buckets = {}
+            for key, entry in entries.items():
+                if entry['source'] not in sources:
+                    if entry['duplicates'] & sources:
+                        self.changed.add(key)
+                    self.add(key, entry['kind'], entry['source'], entry['signature'],
+                             entry['duplicates'] - sources, entry['id'])
+
+    def payload(self, sources):
+        ''' JSON-ready entries of `sources`, dropping references to sources outside them '''
+        with self._lock:
+            return {
+                key: {
+                    'kind': entry['kind'],
+                    'source': entry['source'],
+                    'signature': entry['signature'],
+                    'duplicates': sorted(entry['duplicates'] & sources),
+                    'id': entry['id'],
+                }
+                for key, entry in self.entries.items() if entry['source'] in sources
+            }
+
+    def save(self, path, sources):
+        ''' Persist the entries of `sources`, dropping references to sources no longer indexed '''
+        payload = self.payload(sources)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(payload, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def from_payload(cls, payload, **kwargs):
+        ''' Rebuild an index from the entries returned by `payload` '''
+        index = cls(**kwargs)
+        for key, entry in payload.items():
+            index.add(key, entry['kind'], entry['source'], entry['signature'], entry['duplicates'], entry.get('id'))
+        return index
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        ''' Load a saved index, or an empty one when there is none '''
+        try:
+            with open(path) as f:
+                payload = json.load(f)
+        except (OSError, ValueError):
+            payload = {}
+        return cls.from_payload(payload, **kwargs)
@@ -0,0 +1,98 @@
+import asyncio
+import os
+from collections import OrderedDict
+
+from telemetry import incr, span
+
+# Query embeddings from concurrent chat sessions are coalesced into one request per short window
+DEFAULT_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5"))
+DEFAULT_MAX_BATCH = int(os.getenv("EMBEDDING_BATCH_MAX", "64"))
+DEFAULT_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "256"))
+
+class QueryEmbeddingBatcher:
+    '''
+    Async coalescer in front of an embeddings model. Queries arriving within `window_ms` of each
+    other go out as one `aembed_documents` request, identical in-flight queries share a single
+    future, and the last `cache_size` query vectors are kept in an LRU.
+    '''
+
+    def __init__(self, embeddings, window_ms=DEFAULT_WINDOW_MS, max_batch=DEFAULT_MAX_BATCH, cache_size=DEFAULT_CACHE_SIZE):
+        self.embeddings = embeddings
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._in_flight = {}
+        self._pending = []
+        self._flush_handle = None
+        # The event loop only keeps weak references to tasks, so running flushes are held here
+        self._flush_tasks = set()
+
+    async def aembed_query(self, text):
+        vector = self._cache.get(text)
+        if vector is not None:
+            self._cache.move_to_end(text)
+            incr("query_embedding_cache_hits_total")
+            return vector
+
+        # Single flight: identical questions already being embedded wait on the same result
+        future = self._in_flight.get(text)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._in_flight[text] = future
+            self._pending.append(text)
+            if len(self._pending) >= self.max_batch:
+                self._schedule_flush(0)
+            elif self._flush_handle is None:
+                self._schedule_flush(self.window)
+        else:
+            incr("query_embedding_deduplicated_total")
+        return await asyncio.shield(future)
+
+    def embed_query(self, text):
+        ''' Synchronous fallback for callers outside the event loop '''
+        return self.embeddings.embed_query(text)
+
+    def _schedule_flush(self, delay):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        loop = asyncio.get_running_loop()
+        self._flush_handle = loop.call_later(delay, self._start_flush, loop)
+
+    def _start_flush(self, loop):
+        task = loop.create_task(self._flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _flush(self):
+        self._flush_handle = None
+        batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+        if self._pending:
+            self._schedule_flush(0)
+        if not batch:
+            return
+
+        incr("query_embedding_requests_total")
+        incr("query_embedding_texts_total", len(batch))
+        try:
+            with span("retrieve.embed_query_batch"):
+                vectors = await self.embeddings.aembed_documents(batch)
+        except Exception as e:
+            for text in batch:
+                future = self._in_flight.pop(text)
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for text, vector in zip(batch, vectors):
+            self._remember(text, vector)
+            future = self._in_flight.pop(text)
+            if not future.done():
+                future.set_result(vector)
+
+    def _remember(self, text, vector):
+        self._cache[text] = vector
+        self._cache.move_to_end(text)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
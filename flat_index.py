@@ -0,0 +1,336 @@
+import json
+import mmap
+import os
+import shutil
+import uuid
+
+import numpy as np
+from langchain_core.documents import Document
+
+VECTOR_DTYPES = ('float16', 'int8')
+# Rows converted to float32 at a time during search and merges, bounding the temporary memory
+SEARCH_BLOCK_ROWS = 8192
+# A segment is rewritten without its deleted rows once they make up more than this share of it
+MAX_DEAD_FRACTION = 0.5
+
+def quantize(vectors, dtype):
+    ''' Unit-normalize the rows and convert them to the storage dtype; int8 rows also get a float32 scale '''
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    vectors = vectors / norms
+    if dtype == 'int8':
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    return vectors.astype(np.float16), None
+
+class Segment:
+    ''' One immutable, memory-mapped batch of rows; rows listed in `dead` were deleted or replaced since '''
+
+    def __init__(self, path, dead=()):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(os.path.join(path, "ids.json")) as f:
+            sidecar = json.load(f)
+        self.dtype = sidecar['dtype']
+        self.ids = sidecar['ids']
+        self.types = sidecar['types']
+        self.dead = set(dead)
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode='r')
+        self.scales = np.load(os.path.join(path, "scales.npy"), mmap_mode='r') if self.dtype == 'int8' else None
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        with open(os.path.join(path, "records.jsonl"), "rb") as f:
+            self.records = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @property
+    def live_rows(self):
+        return len(self.ids) - len(self.dead)
+
+    def live(self):
+        ''' Indexes of the rows that are not dead '''
+        keep = np.ones(len(self.ids), dtype=bool)
+        if self.dead:
+            keep[np.fromiter(self.dead, dtype=np.int64)] = False
+        return np.flatnonzero(keep)
+
+    def record(self, row):
+        return self.records[self.offsets[row]:self.offsets[row + 1]]
+
+    def read_blocks(self, block_rows):
+        '''
+        Live rows as `(vectors, scales, records)` blocks read with plain file reads, so merging a
+        segment never maps it into this process's memory.
+        '''
+        width = self.vectors.shape[1] if self.vectors.ndim == 2 else 0
+        live = self.live()
+        for start in range(0, len(self.ids), block_rows):
+            stop = min(start + block_rows, len(self.ids))
+            rows = live[(live >= start) & (live < stop)]
+            if not len(rows):
+                continue
+            vectors = np.fromfile(os.path.join(self.path, "vectors.npy"), dtype=self.vectors.dtype, count=(stop - start) * width,
+                                  offset=self.vectors.offset + start * width * self.vectors.itemsize).reshape(-1, width)[rows - start]
+            scales = None
+            if self.scales is not None:
+                scales = np.fromfile(os.path.join(self.path, "scales.npy"), dtype=np.float32, count=stop - start,
+                                     offset=self.scales.offset + start * 4)[rows - start]
+            with open(os.path.join(self.path, "records.jsonl"), "rb") as f:
+                f.seek(self.offsets[start])
+                data = f.read(self.offsets[stop] - self.offsets[start])
+            base = self.offsets[start]
+            records = [data[self.offsets[row] - base:self.offsets[row + 1] - base] for row in rows]
+            yield vectors, scales, records
+
+    def scores(self, query):
+        ''' Cosine similarity of every row with the unit-normalized query '''
+        scores = np.empty(len(self.ids), dtype=np.float32)
+        for start in range(0, len(self.ids), SEARCH_BLOCK_ROWS):
+            block = self.vectors[start:start + SEARCH_BLOCK_ROWS]
+            scores[start:start + len(block)] = block.astype(np.float32) @ query
+        if self.scales is not None:
+            scores *= self.scales
+        return scores
+
+def _write_array_header(f, dtype, shape):
+    np.lib.format.write_array_header_1_0(
+        f, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': shape})
+
+def write_segment(directory, dtype, ids, types, blocks):
+    '''
+    Write a new segment from `(vectors, scales, records)` blocks, where `vectors` and `scales` are
+    already quantized to `dtype`, appending them to the files so only one block is in memory at a time.
+    Returns the segment's directory name.
+    '''
+    name = f"segment-{uuid.uuid4().hex}"
+    path = os.path.join(directory, name)
+    os.makedirs(path)
+    rows = len(ids)
+    offsets = np.zeros(rows + 1, dtype=np.int64)
+    row = 0
+    vectors_out = scales_out = None
+    try:
+        records_out = open(os.path.join(path, "records.jsonl"), "wb")
+        for vectors, scales, records in blocks:
+            if vectors_out is None:
+                vectors_out = open(os.path.join(path, "vectors.npy"), "wb")
+                _write_array_header(vectors_out, vectors.dtype, (rows, vectors.shape[1]))
+                if dtype == 'int8':
+                    scales_out = open(os.path.join(path, "scales.npy"), "wb")
+                    _write_array_header(scales_out, np.float32, (rows,))
+            vectors_out.write(np.ascontiguousarray(vectors).tobytes())
+            if scales_out is not None:
+                scales_out.write(np.asarray(scales, dtype=np.float32).tobytes())
+            for record in records:
+                records_out.write(record)
+                offsets[row + 1] = offsets[row] + len(record)
+                row += 1
+    finally:
+        for f in (records_out, vectors_out, scales_out):
+            if f is not None:
+                f.close()
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    with open(os.path.join(path, "ids.json"), "w") as f:
+        json.dump({'dtype': dtype, 'ids': ids, 'types': types}, f)
+    return name
+
+class FlatVectorStore:
+    '''
+    Exact cosine-similarity index over memory-mapped float16 or int8 matrices.
+
+    The index is a list of append-only segments under `<persist_directory>/flat/`, each with
+    `vectors.npy` (and `scales.npy` for int8) holding one unit-normalized row per document,
+    `ids.json` with the IDs and types, and `records.jsonl` with the content and metadata, addressed
+    by the byte offsets in `offsets.npy`. An upsert writes only its own rows as a new segment and
+    marks replaced rows dead; deletes only mark rows dead. `MANIFEST.json` lists the live segments
+    and their dead rows and is replaced atomically, so readers in other processes keep a
+    consistent, read-only, page-cache-shared view. Segments are merged log-structured (a segment
+    is merged into the one before it while that one is no larger), which keeps their number
+    logarithmic in the corpus size and the total write volume O(N log N); a segment whose rows are
+    mostly dead is rewritten without them. Merges stream block by block, so memory stays flat.
+    Implements the parts of the Chroma vector store interface that ingestion and retrieval use.
+    '''
+
+    def __init__(self, embedding_function, persist_directory, dtype='float16'):
+        if dtype not in VECTOR_DTYPES:
+            raise ValueError(f"Unsupported vector dtype {dtype!r}, expected one of {VECTOR_DTYPES}")
+        self._embedding_function = embedding_function
+        self.directory = os.path.join(persist_directory, "flat")
+        self.manifest_path = os.path.join(self.directory, "MANIFEST.json")
+        self.dtype = dtype
+        self._load()
+
+    @property
+    def embeddings(self):
+        return self._embedding_function
+
+    def _load(self, segments=None):
+        ''' Open the segments listed in the manifest, or adopt the ones a write just published '''
+        if segments is None:
+            try:
+                with open(self.manifest_path) as f:
+                    manifest = json.load(f)
+            except OSError:
+                manifest = {'segments': []}
+            segments = [Segment(os.path.join(self.directory, entry['name']), entry['dead'])
+                        for entry in manifest['segments']]
+
+        self.segments = segments
+        self.ids = [doc_id for segment in self.segments for doc_id in segment.ids]
+        self.types = np.array([kind for segment in self.segments for kind in segment.types], dtype=object)
+        self.bases = np.cumsum([0] + [len(segment.ids) for segment in self.segments])
+        self.alive = np.ones(len(self.ids), dtype=bool)
+        for segment, base in zip(self.segments, self.bases):
+            if segment.dead:
+                self.alive[base + np.fromiter(segment.dead, dtype=np.int64)] = False
+        self._positions = {self.ids[row]: row for row in np.flatnonzero(self.alive)}
+
+    def _locate(self, row):
+        index = int(np.searchsorted(self.bases, row, side='right')) - 1
+        return self.segments[index], row - self.bases[index]
+
+    def _record(self, row):
+        segment, local = self._locate(row)
+        return json.loads(segment.record(local))
+
+    def _document(self, row):
+        record = self._record(row)
+        return Document(page_content=record['page_content'], metadata=record['metadata'])
+
+    def _blocks(self, segment):
+        ''' Live rows of a segment as `(vectors, scales, records)` blocks in this store's dtype '''
+        for vectors, scales, records in segment.read_blocks(SEARCH_BLOCK_ROWS):
+            if segment.dtype != self.dtype:
+                # Rows written with another precision are converted when their segment is merged
+                vectors, scales = quantize(vectors * (scales[:, None] if scales is not None else 1.0), self.dtype)
+            yield vectors, scales, records
+
+    def _merge(self, segments):
+        ''' Rewrite the live rows of consecutive segments as one, returning its name or None if nothing is left '''
+        ids = [segment.ids[row] for segment in segments for row in segment.live()]
+        if not ids:
+            return None
+        types = [segment.types[row] for segment in segments for row in segment.live()]
+        blocks = (block for segment in segments for block in self._blocks(segment))
+        return write_segment(self.directory, self.dtype, ids, types, blocks)
+
+    def _publish(self, entries):
+        '''
+        Apply the merge policy to the `[(name, dead rows)]` segment list, then atomically replace the
+        manifest and remove the segments it no longer references.
+        '''
+        segments = {segment.name: segment for segment in self.segments}
+        opened = lambda name, dead: segments[name] if name in segments else Segment(os.path.join(self.directory, name), dead)
+        current = []
+        for name, dead in entries:
+            segment = opened(name, dead)
+            segment.dead = set(dead)
+            if segment.dead and len(segment.dead) > MAX_DEAD_FRACTION * len(segment.ids):
+                name = self._merge([segment])
+                segment = opened(name, ()) if name else None
+            if segment is None:
+                continue
+            current.append(segment)
+            while len(current) > 1 and current[-2].live_rows <= current[-1].live_rows:
+                name = self._merge(current[-2:])
+                del current[-2:]
+                if name:
+                    current.append(opened(name, ()))
+
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({'segments': [{'name': segment.name, 'dead': sorted(segment.dead)} for segment in current]}, f)
+        os.replace(tmp_path, self.manifest_path)
+        # Processes that still map an older segment keep reading it until they reopen
+        live = {segment.name for segment in current}
+        for name in os.listdir(self.directory):
+            if name not in live and os.path.isdir(os.path.join(self.directory, name)):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        self._load(current)
+
+    def _entries(self, removed=()):
+        ''' Current `[(segment name, dead rows)]`, with the live rows of the `removed` IDs marked dead '''
+        dead = {segment.name: set(segment.dead) for segment in self.segments}
+        for doc_id in removed:
+            row = self._positions.get(doc_id)
+            if row is not None:
+                segment, local = self._locate(row)
+                dead[segment.name].add(int(local))
+        return [(segment.name, dead[segment.name]) for segment in self.segments]
+
+    def add_documents(self, documents, ids):
+        ''' Upsert documents under the given IDs, embedding their page content '''
+        # The last document given for an ID wins, as with repeated upserts
+        last = {doc_id: position for position, doc_id in enumerate(ids)}
+        documents = [documents[position] for position in sorted(last.values())]
+        ids = [ids[position] for position in sorted(last.values())]
+        if not documents:
+            return []
+        vectors, scales = quantize(self._embedding_function.embed_documents([d.page_content for d in documents]), self.dtype)
+        records = [
+            (json.dumps({'page_content': d.page_content, 'metadata': d.metadata}) + "\n").encode('utf-8')
+            for d in documents
+        ]
+        os.makedirs(self.directory, exist_ok=True)
+        name = write_segment(self.directory, self.dtype, list(ids), [d.metadata.get('type') for d in documents],
+                             [(vectors, scales, records)])
+        self._publish(self._entries(ids) + [(name, ())])
+        return list(ids)
+
+    def delete(self, ids=None):
+        if not any(doc_id in self._positions for doc_id in ids or ()):
+            return
+        self._publish(self._entries(ids))
+
+    def delete_collection(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self._load()
+
+    def _mask(self, where):
+        ''' Row mask for a Chroma-style filter on the document type, e.g. `{'type': {'$in': ['text']}}` '''
+        if not where:
+            return None
+        unsupported = set(where) - {'type'}
+        if unsupported:
+            raise ValueError(f"FlatVectorStore can only filter on 'type', not {sorted(unsupported)}")
+        condition = where['type']
+        allowed = condition['$in'] if isinstance(condition, dict) else [condition]
+        return np.isin(self.types, allowed)
+
+    def get(self, ids=None, where=None, include=('documents', 'metadatas')):
+        if ids is None:
+            rows = np.flatnonzero(self.alive)
+        else:
+            rows = np.array([self._positions[doc_id] for doc_id in ids if doc_id in self._positions], dtype=np.int64)
+        mask = self._mask(where)
+        if mask is not None:
+            rows = rows[mask[rows]]
+        records = [self._record(row) for row in rows] if {'documents', 'metadatas'} & set(include) else []
+        return {
+            'ids': [self.ids[row] for row in rows],
+            'documents': [r['page_content'] for r in records] if 'documents' in include else None,
+            'metadatas': [r['metadata'] for r in records] if 'metadatas' in include else None,
+        }
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        ''' Top `k` documents by cosine similarity, optionally restricted to some document types '''
+        if not self.segments or k <= 0:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        scores = np.concatenate([segment.scores(query) for segment in self.segments])
+
+        mask = self.alive
+        where = self._mask(filter)
+        if where is not None:
+            mask = mask & where
+        scores[~mask] = -np.inf
+        k = min(k, int(mask.sum()))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [self._document(row) for row in top]
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return self.similarity_search_by_vector(self._embedding_function.embed_query(query), k, filter)
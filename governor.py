@@ -0,0 +1,173 @@
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+
+from langchain_core.runnables import RunnableLambda
+
+from telemetry import incr, observe
+
+# One budget for every model request in the process, shared by the chat app and ingestion.
+# MODEL_TOKENS_PER_MINUTE=0 disables the token-rate limit and only bounds concurrency.
+MODEL_MAX_CONCURRENCY = int(os.getenv("MODEL_MAX_CONCURRENCY", "16"))
+MODEL_TOKENS_PER_MINUTE = float(os.getenv("MODEL_TOKENS_PER_MINUTE", "0"))
+
+# Lower values are served first
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background'}
+
+# Priority of the model requests made from the current context; ingestion runs as BACKGROUND
+request_priority = ContextVar("request_priority", default=INTERACTIVE)
+
+@contextmanager
+def background_priority():
+    ''' Queue the model requests made inside the block behind interactive ones; also usable as a decorator '''
+    token = request_priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+def estimate_tokens(text, completion_tokens=0):
+    ''' Rough token cost of a request: about four characters per prompt token plus the completion budget '''
+    return len(text) // 4 + completion_tokens
+
+class ModelGovernor:
+    '''
+    Process-wide admission control for model requests. At most `max_concurrency` requests are in
+    flight, their estimated tokens are drawn from a bucket refilled at `tokens_per_minute`, and
+    waiting requests are admitted by priority, then in arrival order. Works across threads and
+    event loops, so the sync ingestion batches and the async chat sessions share one budget.
+    '''
+
+    def __init__(self, max_concurrency=MODEL_MAX_CONCURRENCY, tokens_per_minute=MODEL_TOKENS_PER_MINUTE):
+        self.max_concurrency = max_concurrency
+        self.rate = tokens_per_minute / 60.0
+        self.capacity = tokens_per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        self._timer = None
+
+    def _enqueue(self, priority, tokens, wake):
+        with self._lock:
+            heapq.heappush(self._waiters, (priority, next(self._sequence), tokens, wake))
+            self._dispatch()
+
+    def _dispatch(self):
+        # Called with the lock held
+        if self.rate:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+        while self._waiters and self._in_flight < self.max_concurrency:
+            _, _, tokens, wake = self._waiters[0]
+            if self.rate:
+                # A request larger than the whole bucket still goes through once the bucket is full
+                tokens = min(tokens, self.capacity)
+                if self._tokens < tokens:
+                    self._dispatch_later((tokens - self._tokens) / self.rate)
+                    return
+                self._tokens -= tokens
+            heapq.heappop(self._waiters)
+            self._in_flight += 1
+            wake()
+
+    def _dispatch_later(self, delay):
+        if self._timer is None:
+            self._timer = threading.Timer(delay, self._on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            self._dispatch()
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+            self._dispatch()
+
+    def _admitted(self, priority, start):
+        observe("model.queue_wait", time.perf_counter() - start)
+        incr("model_requests_total", priority=PRIORITY_NAMES.get(priority, priority))
+
+    @contextmanager
+    def slot(self, tokens=0, priority=None):
+        ''' Block until the request may be sent, and hold its slot for the duration of the block '''
+        priority = request_priority.get() if priority is None else priority
+        start = time.perf_counter()
+        granted = threading.Event()
+        self._enqueue(priority, tokens, granted.set)
+        granted.wait()
+        self._admitted(priority, start)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def aslot(self, tokens=0, priority=None):
+        ''' Async version of `slot`; waiting does not block the event loop '''
+        priority = request_priority.get() if priority is None else priority
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def grant():
+            # A caller cancelled while queued hands its slot straight back
+            if granted.cancelled():
+                self.release()
+            else:
+                granted.set_result(None)
+
+        self._enqueue(priority, tokens, lambda: loop.call_soon_threadsafe(grant))
+        try:
+            await granted
+        except asyncio.CancelledError:
+            if granted.done() and not granted.cancelled():
+                self.release()
+            raise
+        self._admitted(priority, start)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': self._in_flight, 'queued': len(self._waiters), 'tokens_available': self._tokens}
+
+_governor = None
+_governor_lock = threading.Lock()
+
+def get_governor():
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            _governor = ModelGovernor()
+    return _governor
+
+def governed(model, completion_tokens=0):
+    ''' Runnable that sends each call to `model` through the governor, for use inside chains '''
+    def cost(value):
+        return estimate_tokens(value.to_string() if hasattr(value, 'to_string') else str(value), completion_tokens)
+
+    def invoke(value, config):
+        with get_governor().slot(cost(value)):
+            return model.invoke(value, config)
+
+    async def ainvoke(value, config):
+        async with get_governor().aslot(cost(value)):
+            return await model.ainvoke(value, config)
+
+    return RunnableLambda(invoke, afunc=ainvoke, name="governed")
@@ -1,13 +1,19 @@
 import os
+import asyncio
 import base64
+import contextvars
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
-from langchain.schema.messages import HumanMessage, SystemMessage
-from langchain_community.chat_models import ChatOpenAI
-from IPython.display import display, HTML
-from llms import get_multimodal_llm
+from langchain_core.messages import HumanMessage, SystemMessage
+from governor import estimate_tokens, get_governor
+from llms import MAX_COMPLETION_TOKENS, get_multimodal_llm, get_vision_llm
+from summary_cache import get_summary_cache, make_key, model_name
+from telemetry import span
 import io
 from base64 import b64decode
-import matplotlib.pyplot as plt
 
 current_working_directory = os.getcwd()
 path = os.path.join(current_working_directory, 'Data')
@@ -19,69 +25,248 @@ def encode_image(image_path):
 
 
 
-def image_summarize(img_base64, prompt):
-    ''' Image summary '''
-    chat = ChatOpenAI(model="gpt-4-vision-preview", max_tokens=1024)  # Make sure llm2 is an instance of a class that can invoke a language model
-    
-    try:
-        msg = chat.invoke(
-            [
-                HumanMessage(
-                    content=[
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{img_base64}"
-                            },
-                        },
-                    ]
-                )
+# Bounds for the image summarization stage
+IMAGE_SUMMARY_CONCURRENCY = int(os.getenv("IMAGE_SUMMARY_CONCURRENCY", "5"))
+IMAGE_SUMMARY_RPM = float(os.getenv("IMAGE_SUMMARY_RPM", "60"))
+IMAGE_SUMMARY_RETRIES = int(os.getenv("IMAGE_SUMMARY_RETRIES", "5"))
+# Images are summarized from resized derivatives; a 300px wide image is a single 512px tile at high detail
+IMAGE_WIDTH = 300
+IMAGE_TOKENS = 255
+# Derivatives are cached by source hash and width, so unchanged images are never resized twice
+derivative_directory = os.path.join(current_working_directory, "cache", "derivatives")
+IMAGE_PREPROCESS_WORKERS = int(os.getenv("IMAGE_PREPROCESS_WORKERS", str(min(8, os.cpu_count() or 1))))
+
+_image_chat = None
+# Concurrency and rate limits shared by every summarize_images call, keyed by their settings
+_image_limits = {}
+_background_loop = None
+_background_loop_lock = threading.Lock()
+
+def get_image_chat():
+    ''' Shared vision model client; retries are handled by summarize_images '''
+    global _image_chat
+    if _image_chat is None:
+        _image_chat = get_vision_llm()
+    return _image_chat
+
+def image_message(img_base64, prompt):
+    return [
+        HumanMessage(
+            content=[
+                {"type": "text", "text": prompt},
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:image/jpeg;base64,{img_base64}"
+                    },
+                },
             ]
         )
-        
-        if isinstance(msg, str):
-            return msg  # If the response is a string
-        elif hasattr(msg, 'content'):
-            return msg.content  # If the response is an object with a 'content' attribute
-        else:
-            return str(msg) 
-    except Exception as e:
-        # Catch any other exception that might occur
-        print(f"An error occurred during image summarization: {e}")
-        return str(e)  # Return the error as a string
-
-def resize_image(image_path, base_width=300):
-    img = Image.open(image_path)
-    w_percent = (base_width / float(img.size[0]))
-    h_size = int((float(img.size[1]) * float(w_percent)))
-    # Use Image.Resampling.LANCZOS or Image.LANCZOS for compatibility
-    img = img.resize((base_width, h_size), Image.Resampling.LANCZOS)
-    img.save(image_path)  # Save the resized image
-
-# Prompt
-prompt = """You are an assistant tasked with summarizing images for retrieval. \
-These summaries will be embedded and used to retrieve the raw image. \
-Give a concise summary of the image that is well optimized for retrieval. \
-Describe the image in detail. Be specific about graphs, such as bar plots, curves."""
-
-def process_images(path, prompt):
-    img_base64_list = []
-    image_summaries = []
-    for img_file in sorted(os.listdir(path)):
-        if img_file.endswith('.jpg'):
-            img_path = os.path.join(path, img_file)
-            resize_image(img_path)
-            base64_image = encode_image(img_path)
-            img_base64_list.append(base64_image)
-            try:
-                image_summary = image_summarize(base64_image, prompt)
-                image_summaries.append(image_summary)
-            except AttributeError as e:
-                print(f"An error occurred: {e}")
-    return img_base64_list, image_summaries
-
-def plt_img_base64(img_base64):
+    ]
+
+def message_text(msg):
+    if isinstance(msg, str):
+        return msg  # If the response is a string
+    elif hasattr(msg, 'content'):
+        return msg.content  # If the response is an object with a 'content' attribute
+    else:
+        return str(msg)
+
+def image_request_tokens(prompt):
+    return estimate_tokens(prompt, MAX_COMPLETION_TOKENS) + IMAGE_TOKENS
+
+def image_summarize(img_base64, prompt):
+    ''' Image summary; raises on failure so errors never end up embedded as summaries '''
+    cache = get_summary_cache()
+    chat = get_image_chat()
+    cache_key = make_key(b64decode(img_base64), prompt, model_name(chat))
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    with get_governor().slot(image_request_tokens(prompt)):
+        summary = message_text(chat.invoke(image_message(img_base64, prompt)))
+    cache.put(cache_key, summary)
+    return summary
+
+class TokenBucket:
+    ''' Async token bucket allowing `rate` acquisitions per second with bursts of up to `capacity` '''
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def is_retryable(error):
+    ''' Rate limits, server errors and connection problems are worth retrying '''
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return type(error).__name__ in ('APIConnectionError', 'APITimeoutError', 'TimeoutError')
+
+def image_limits(max_concurrency, requests_per_minute):
+    '''
+    `(semaphore, token bucket)` shared by every image batch with these settings, so the rate holds
+    across the whole ingestion run instead of restarting with a full burst per batch. Only used
+    from the background loop, which the asyncio primitives belong to.
+    '''
+    key = (max_concurrency, requests_per_minute)
+    if key not in _image_limits:
+        _image_limits[key] = (asyncio.Semaphore(max_concurrency),
+                              TokenBucket(requests_per_minute / 60.0, capacity=max_concurrency))
+    return _image_limits[key]
+
+async def summarize_images(img_base64_list, prompt, max_concurrency=IMAGE_SUMMARY_CONCURRENCY,
+                           requests_per_minute=IMAGE_SUMMARY_RPM, max_retries=IMAGE_SUMMARY_RETRIES):
+    ''' Summarize images concurrently; returns (summaries, failures) with None summaries for failed items '''
+    cache = get_summary_cache()
+    chat = get_image_chat()
+    semaphore, bucket = image_limits(max_concurrency, requests_per_minute)
+    summaries = [None] * len(img_base64_list)
+    failures = {}
+
+    async def summarize(index, img_base64):
+        cache_key = make_key(b64decode(img_base64), prompt, model_name(chat))
+        cached = cache.get(cache_key)
+        if cached is not None:
+            summaries[index] = cached
+            return
+        async with semaphore:
+            for attempt in range(max_retries + 1):
+                await bucket.acquire()
+                try:
+                    async with get_governor().aslot(image_request_tokens(prompt)):
+                        summary = message_text(await chat.ainvoke(image_message(img_base64, prompt)))
+                except Exception as e:
+                    if attempt == max_retries or not is_retryable(e):
+                        print(f"An error occurred during image summarization: {e}")
+                        failures[index] = f"{type(e).__name__}: {e}"
+                        return
+                    # Exponential backoff with jitter
+                    await asyncio.sleep(min(60, 2 ** attempt) * (0.5 + random.random()))
+                else:
+                    cache.put(cache_key, summary)
+                    summaries[index] = summary
+                    return
+
+    await asyncio.gather(*(summarize(i, b) for i, b in enumerate(img_base64_list)))
+    return summaries, failures
+
+def background_loop():
+    '''
+    Long-lived event loop in a daemon thread for the async work of synchronous callers. The shared
+    vision client's async connections belong to the loop that opened them, so every image batch
+    has to run in this same loop rather than in a fresh `asyncio.run` each time.
+    '''
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, name="image-summaries", daemon=True).start()
+    return _background_loop
+
+def run_coroutine(coroutine):
+    ''' Run a coroutine to completion on the background loop from synchronous code, even inside a running loop '''
+    # Carry the caller's context over, so the request priority applies in the background loop too
+    return contextvars.copy_context().run(asyncio.run_coroutine_threadsafe, coroutine, background_loop()).result()
+
+def derivative_path(source_hash, base_width=IMAGE_WIDTH, directory=None):
+    return os.path.join(directory or derivative_directory, f"{source_hash}_{base_width}.jpg")
+
+def resize_image(image_path, base_width=IMAGE_WIDTH, source_hash=None, directory=None):
+    '''
+    Path of the resized RGB JPEG derivative of an image, creating it on first use.
+    The source file is never modified; derivatives are keyed by its content hash and the width.
+    '''
+    if source_hash is None:
+        from retriver import file_sha256
+        source_hash = file_sha256(image_path)
+    derivative = derivative_path(source_hash, base_width, directory)
+    if os.path.exists(derivative):
+        return derivative
+
+    with Image.open(image_path) as img:
+        w_percent = (base_width / float(img.size[0]))
+        h_size = int((float(img.size[1]) * float(w_percent)))
+        resized = img.convert("RGB").resize((base_width, h_size), Image.Resampling.LANCZOS)
+    os.makedirs(os.path.dirname(derivative), exist_ok=True)
+    # Write-then-rename so concurrent ingestion runs never read a partial derivative
+    tmp_path = f"{derivative}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        resized.save(tmp_path, format="JPEG")
+        os.replace(tmp_path, derivative)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return derivative
+
+def prune_derivatives(keep, directory=None):
+    ''' Delete derivatives of sources whose hash is not in `keep`, returning how many were removed '''
+    directory = directory or derivative_directory
+    removed = 0
+    if not os.path.isdir(directory):
+        return removed
+    for name in os.listdir(directory):
+        if name.rsplit("_", 1)[0] not in keep:
+            os.remove(os.path.join(directory, name))
+            removed += 1
+    return removed
+
+def process_images(path, prompt, image_files=None, source_hashes=None, max_workers=IMAGE_PREPROCESS_WORKERS):
+    '''
+    Resize, encode and summarize images; returns (img_base64_list, image_summaries, failures).
+    `source_hashes` maps image files to their content hashes when the caller already computed them.
+    '''
+    if image_files is None:
+        image_files = [os.path.relpath(os.path.join(root, f), path) for root, _, files in os.walk(path) for f in files]
+    image_files = sorted(f for f in image_files if f.endswith('.jpg'))
+    source_hashes = source_hashes or {}
+
+    def preprocess(img_file):
+        ''' `(img_base64, None)`, or `(None, error)` for an unreadable image, which is reported like a failed summary '''
+        try:
+            derivative = resize_image(os.path.join(path, img_file), source_hash=source_hashes.get(img_file))
+            return encode_image(derivative), None
+        except Exception as e:
+            print(f"An error occurred during image preprocessing of {img_file}: {e}")
+            return None, f"{type(e).__name__}: {e}"
+
+    with span("ingest.resize_encode_images"):
+        # Decoding, resampling and JPEG encoding release the GIL, so threads resize in parallel
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            results = list(executor.map(preprocess, image_files))
+    failures = {img_file: error for img_file, (_, error) in zip(image_files, results) if error is not None}
+    readable = [(img_file, encoded) for img_file, (encoded, error) in zip(image_files, results) if error is None]
+
+    with span("ingest.summarize_images"):
+        summaries, errors = run_coroutine(summarize_images([encoded for _, encoded in readable], prompt))
+
+    # Failed images are reported separately instead of being embedded with the error text
+    img_base64_list = [encoded for (_, encoded), s in zip(readable, summaries) if s is not None]
+    image_summaries = [s for s in summaries if s is not None]
+    failures.update({readable[i][0]: error for i, error in errors.items()})
+    return img_base64_list, image_summaries, failures
+
+def display_img_base64(img_base64):
+    ''' Render a base64-encoded image inline in a notebook '''
+    # Notebook-only dependency, imported on use so the pipeline never loads it
+    from IPython.display import display, HTML
 
     # Create an HTML img tag with the base64 string as the source
     image_html = f'<img src="data:image/jpeg;base64,{img_base64}" />'
@@ -108,6 +293,8 @@ def split_image_text_types(docs):
 
 def plt_img_base64(base64_str):
     ''' Display a base64-encoded image using matplotlib '''
+    import matplotlib.pyplot as plt
+
     image = Image.open(io.BytesIO(b64decode(base64_str)))
     plt.imshow(image)
     plt.axis('off')
@@ -0,0 +1,356 @@
+import argparse
+import contextvars
+import os
+import queue
+import shutil
+import threading
+import time
+from base64 import b64decode
+from dotenv import load_dotenv
+from langchain_core.documents import Document
+from process_pdfs import DEFAULT_MAX_WORKERS, figures_directory, partition_pdfs
+from image_processing import process_images, prune_derivatives
+from dedup import NearDuplicateIndex, image_signature, text_signature
+from governor import background_priority
+from llms import get_multimodal_llm
+import retriver
+from prompts import image_summary_prompt, summary_prompt
+from summary_cache import get_summary_cache
+from blob_store import get_blob_store
+from telemetry import log_snapshot, span, timed
+load_dotenv()
+
+# Finished sources buffered ahead of the upsert stage, and images encoded and summarized per batch
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "4"))
+INGEST_IMAGE_BATCH = int(os.getenv("INGEST_IMAGE_BATCH", "32"))
+
+def diff_sources(current, indexed):
+    ''' Split the current source hashes into new/changed (or previously failed) and removed relative to the indexed ones '''
+    changed = [name for name, digest in current.items()
+               if indexed.get(name, {}).get('hash') != digest or 'failed' in indexed[name]]
+    removed = [name for name in indexed if name not in current]
+    return changed, removed
+
+def collapsed_dependents(indexed, stale, suffix):
+    ''' Unchanged sources with elements collapsed into a stale source; they are re-ingested to restore those elements '''
+    stale = set(stale)
+    dependents = []
+    while True:
+        found = [name for name, entry in indexed.items()
+                 if name.endswith(suffix) and name not in stale and stale & set(entry.get('collapsed_into', ()))]
+        if not found:
+            return dependents
+        dependents.extend(found)
+        stale.update(found)
+
+def indexed_sources(sources):
+    ''' Sources with vectors in the index; failed ones have none, so nothing may stay collapsed into them '''
+    return {name for name, entry in sources.items() if 'failed' not in entry}
+
+class IndexWriter:
+    '''
+    Last stage of the ingestion pipeline. A background thread takes `(source, entry, documents)`
+    units from a bounded queue, upserts their documents in batches, deletes the vectors the sources
+    no longer produce, and checkpoints the sources written so far together with their near-duplicate
+    index entries. `entry` None drops the source.
+    '''
+
+    def __init__(self, vectorstore, sources, dedup_index, queue_size=INGEST_QUEUE_SIZE,
+                 batch_size=retriver.UPSERT_BATCH_SIZE):
+        self.vectorstore = vectorstore
+        self.sources = dict(sources)
+        self.dedup_index = dedup_index
+        self.batch_size = batch_size
+        self.documents_written = 0
+        self.vectors_deleted = 0
+        self.error = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        # Run in a copy of the caller's context so model requests keep the ingestion priority
+        self._thread = threading.Thread(target=contextvars.copy_context().run, args=(self._run,), daemon=True)
+        self._thread.start()
+
+    def put(self, source, entry, documents=()):
+        '''
+        Queue one finished source; blocks while the writer is `queue_size` units behind. Raises the
+        writer's error once a flush failed, so the producer stops before summarizing sources that
+        could not be written anyway.
+        '''
+        if self.error is not None:
+            raise self.error
+        self._queue.put((source, entry, list(documents)))
+
+    def close(self, raise_error=True):
+        ''' Flush the remaining units and return the sources now in the index '''
+        self._queue.put(None)
+        self._thread.join()
+        if raise_error and self.error is not None:
+            raise self.error
+        return self.sources
+
+    def _run(self):
+        units = []
+        pending = 0
+        while True:
+            unit = self._queue.get()
+            if unit is None:
+                break
+            if self.error is not None:
+                # Keep draining so the producer never blocks on a dead writer
+                continue
+            units.append(unit)
+            pending += len(unit[2])
+            if pending >= self.batch_size:
+                self._flush(units)
+                units, pending = [], 0
+        if self.error is None and units:
+            self._flush(units)
+
+    def _flush(self, units):
+        try:
+            documents = [document for _, _, unit_documents in units for document in unit_documents]
+            previous_ids = set()
+            for source, entry, _ in units:
+                previous_ids.update(self.sources.get(source, {}).get('ids', ()))
+                if entry is None:
+                    self.sources.pop(source, None)
+                else:
+                    self.sources[source] = entry
+            # IDs are content-derived, so an ID still produced by any source is upserted rather than deleted
+            live_ids = {doc_id for entry in self.sources.values() for doc_id in entry.get('ids', ())}
+            stale_ids = sorted(previous_ids - live_ids)
+            retriver.create_documents_and_vectorstore(
+                documents, [d.metadata['id'] for d in documents], stale_ids, vectorstore=self.vectorstore)
+            # A resumed run starts from these entries, so they must describe exactly the checkpointed sources
+            retriver.write_checkpoint(self.sources, self.dedup_index.payload(indexed_sources(self.sources)))
+            self.documents_written += len(documents)
+            self.vectors_deleted += len(stale_ids)
+        except Exception as e:
+            self.error = e
+
+def record_duplicate_sources(vectorstore, dedup_index, keys, sources):
+    '''
+    Write the sources collapsed into each canonical element under `keys` into its document's
+    `duplicate_sources` metadata (comma-separated; Chroma metadata can't hold lists), re-upserting
+    only the documents whose value changed. Returns how many were rewritten.
+    '''
+    duplicates = dedup_index.duplicate_sources(keys, sources)
+    if not duplicates:
+        return 0
+    stored = vectorstore.get(ids=list(duplicates), include=['documents', 'metadatas'])
+    documents = []
+    for doc_id, content, metadata in zip(stored['ids'], stored['documents'], stored['metadatas']):
+        value = ", ".join(duplicates[doc_id])
+        if metadata.get('duplicate_sources', '') == value:
+            continue
+        metadata = {key: item for key, item in metadata.items() if key != 'duplicate_sources'}
+        if value:
+            metadata['duplicate_sources'] = value
+        documents.append(Document(page_content=content, metadata=metadata))
+    retriver.create_documents_and_vectorstore(documents, [d.metadata['id'] for d in documents], vectorstore=vectorstore)
+    return len(documents)
+
+def pdf_units(data_path, pdf_files, pdf_hashes, dedup_index, llm, max_workers):
+    ''' Partition, classify and summarize changed PDFs, yielding one `(source, entry, documents)` unit per file '''
+    pdf_paths = [os.path.join(data_path, pdf_file) for pdf_file in pdf_files]
+    for pdf_path, elements, error in partition_pdfs(pdf_paths, max_workers):
+        pdf_file = os.path.relpath(pdf_path, data_path)
+        if error is not None:
+            # Recorded as failed: `python ingest.py` retries it, serving doesn't treat the index as stale
+            yield pdf_file, {'hash': pdf_hashes[pdf_file], 'ids': [], 'failed': error}, []
+            continue
+        pdf_hash = pdf_hashes[pdf_file]
+        tables, texts = retriver.tex_tab_elements(elements)
+        del elements
+        element_count = len(texts) + len(tables)
+        # Near-duplicates of elements that are already indexed are dropped before summarization
+        texts, text_collapsed = dedup_index.collapse('text', pdf_file, texts, text_signature)
+        tables, table_collapsed = dedup_index.collapse('table', pdf_file, tables, text_signature)
+        pdf_documents, pdf_ids = retriver.create_documents(
+            pdf_file, pdf_hash,
+            texts, retriver.text_summaries(texts, summary_prompt, llm),
+            tables, retriver.table_summaries(tables, summary_prompt, llm),
+            [], [])
+        dedup_index.assign_ids(pdf_file, 'text', pdf_ids[:len(texts)])
+        dedup_index.assign_ids(pdf_file, 'table', pdf_ids[len(texts):])
+        entry = {'hash': pdf_hash, 'ids': pdf_ids}
+        collapsed_into = sorted(set(text_collapsed + table_collapsed))
+        if collapsed_into:
+            entry['collapsed_into'] = collapsed_into
+        print(f"Processed {pdf_file}: {len(texts)} texts, {len(tables)} tables, "
+              f"{element_count - len(texts) - len(tables)} near-duplicates collapsed")
+        yield pdf_file, entry, pdf_documents
+
+def image_units(data_path, image_files, image_hashes, dedup_index, failures, batch_size=INGEST_IMAGE_BATCH):
+    ''' Collapse, summarize and store changed images in batches, yielding one unit per image '''
+    unique_images = []
+    collapsed = 0
+    for img_file in sorted(image_files):
+        try:
+            kept, collapsed_into = dedup_index.collapse(
+                'image', img_file, [img_file], lambda name: image_signature(os.path.join(data_path, name)))
+        except Exception as e:
+            # Unreadable image: recorded as failed like a failed summary, instead of aborting the run
+            print(f"An error occurred while reading {img_file}: {e}")
+            failures[img_file] = f"{type(e).__name__}: {e}"
+            yield img_file, {'hash': image_hashes[img_file], 'ids': [], 'failed': failures[img_file]}, []
+            continue
+        if kept:
+            unique_images.append(img_file)
+        else:
+            # Indexed through its canonical copy; re-ingested if that copy changes or goes away
+            collapsed += 1
+            yield img_file, {'hash': image_hashes[img_file], 'ids': [],
+                             'collapsed_into': collapsed_into}, []
+    if collapsed:
+        print(f"Collapsed {collapsed} near-duplicate images")
+
+    blob_store = get_blob_store()
+    for start in range(0, len(unique_images), batch_size):
+        batch = unique_images[start:start + batch_size]
+        img_base64_list, image_summaries, batch_failures = process_images(data_path, image_summary_prompt, batch, image_hashes)
+        failures.update(batch_failures)
+        # Failed images are recorded as such so the next ingestion run retries them
+        for img_file, error in batch_failures.items():
+            yield img_file, {'hash': image_hashes[img_file], 'ids': [], 'failed': error}, []
+        summarized = [img_file for img_file in batch if img_file not in batch_failures]
+        for img_file, img_base64, image_summary in zip(summarized, img_base64_list, image_summaries):
+            # Preprocessing leaves the source untouched, so the scanned hash still describes it
+            img_hash = image_hashes[img_file]
+            with span("ingest.store_image"):
+                blob_hash = blob_store.add_image(b64decode(img_base64))
+            img_documents, img_ids = retriver.create_documents(
+                img_file, img_hash, [], [], [], [], [blob_hash], [image_summary])
+            dedup_index.assign_ids(img_file, 'image', img_ids)
+            yield img_file, {'hash': img_hash, 'ids': img_ids, 'blob': blob_hash}, img_documents
+
+@timed("ingest.total")
+@background_priority()
+def run_ingestion(data_path=retriver.path, rebuild=False, max_workers=DEFAULT_MAX_WORKERS):
+    '''
+    Bring the persisted index in line with the data directory, only processing new or changed files.
+    Sources stream through partition, classify, summarize and upsert one at a time, and every
+    upsert batch is checkpointed, so an interrupted run resumes where it stopped.
+    '''
+    previous = retriver.load_manifest()
+    checkpoint = None if rebuild else retriver.load_checkpoint()
+    if checkpoint is not None:
+        # Resume: the store holds exactly the sources checkpointed by the interrupted run
+        rebuild = False
+        indexed = checkpoint['sources']
+        # dedup.json still describes the previous run; the checkpoint carries the entries of exactly its sources
+        dedup_index = NearDuplicateIndex.from_payload(checkpoint.get('dedup', {}))
+        print(f"Resuming an interrupted ingestion run with {len(indexed)} sources already written")
+    else:
+        rebuild = rebuild or previous is None or not retriver.matches_layout(previous)
+        indexed = {} if rebuild else previous.get('sources', {})
+    if rebuild:
+        # Vectors written by another layout or embedding model (or with random IDs) can't be diffed, so start over
+        retriver.open_vectorstore().delete_collection()
+        retriver.write_checkpoint({})
+        dedup_index = NearDuplicateIndex()
+    elif checkpoint is None:
+        dedup_index = NearDuplicateIndex.load(retriver.dedup_index_path)
+
+    # PDFs first: partitioning writes the extracted figures below the data directory
+    # Files whose size and mtime match the manifest are not hashed again
+    scanned = retriver.source_stats(data_path, ('.pdf',), indexed)
+    pdf_hashes = {name: stat['hash'] for name, stat in scanned.items()}
+    changed, removed = diff_sources(pdf_hashes, {
+        name: entry for name, entry in indexed.items() if name.endswith('.pdf')})
+    changed += collapsed_dependents(indexed, changed + removed, '.pdf')
+    dedup_index.discard(changed + removed)
+    for pdf_file in removed:
+        shutil.rmtree(figures_directory(os.path.join(data_path, pdf_file)), ignore_errors=True)
+
+    vectorstore = retriver.open_vectorstore()
+    writer = IndexWriter(vectorstore, indexed, dedup_index)
+    failures = {}
+    try:
+        for source in removed:
+            writer.put(source, None)
+        for unit in pdf_units(data_path, changed, pdf_hashes, dedup_index, get_multimodal_llm(), max_workers):
+            writer.put(*unit)
+
+        # Then the images, including any figures just extracted from changed PDFs
+        image_stats = retriver.source_stats(data_path, ('.jpg',), indexed)
+        scanned.update(image_stats)
+        image_hashes = {name: stat['hash'] for name, stat in image_stats.items()}
+        image_changed, image_removed = diff_sources(image_hashes, {
+            name: entry for name, entry in indexed.items() if name.endswith('.jpg')})
+        image_changed += collapsed_dependents(indexed, image_changed + image_removed, '.jpg')
+        dedup_index.discard(image_changed + image_removed)
+        changed += image_changed
+        removed += image_removed
+        for source in image_removed:
+            writer.put(source, None)
+        for unit in image_units(data_path, image_changed, image_hashes, dedup_index, failures):
+            writer.put(*unit)
+    except BaseException:
+        # Checkpoint what was finished, but report the exception that stopped the producer
+        writer.close(raise_error=False)
+        raise
+    sources = writer.close()
+    # The manifest keeps each file's size and mtime from the scan, so unchanged files are not re-hashed
+    for name, entry in sources.items():
+        stat = scanned.get(name)
+        if stat is not None and stat['hash'] == entry['hash']:
+            sources[name] = dict(entry, size=stat['size'], mtime_ns=stat['mtime_ns'])
+
+    if (checkpoint is None and not rebuild and not changed and not removed
+            and os.path.exists(retriver.lexical_index_path)):
+        if sources != previous['sources']:
+            # Only file stats changed (touched files, or a manifest written before they were recorded)
+            retriver.write_manifest(dict(sorted(sources.items())), previous, bump=False)
+        retriver.clear_checkpoint()
+        print(f"Index is up to date (version {previous['version']})")
+        return vectorstore
+
+    if checkpoint is not None:
+        # A crash between an upsert and its checkpoint can leave vectors no source accounts for
+        live_ids = {doc_id for entry in sources.values() for doc_id in entry.get('ids', ())}
+        orphans = sorted(set(vectorstore.get(include=[])['ids']) - live_ids)
+        if orphans:
+            vectorstore.delete(ids=orphans)
+            print(f"Removed {len(orphans)} vectors left behind by the interrupted run")
+
+    # Canonical documents list the sources collapsed into them; a resumed run lost track of which
+    # changed, so it checks them all
+    keys = dedup_index.entries if checkpoint is not None else dedup_index.changed
+    updated = record_duplicate_sources(vectorstore, dedup_index, list(keys), indexed_sources(sources))
+    if updated:
+        print(f"Updated the duplicate sources of {updated} canonical documents")
+
+    lexical_index = retriver.build_lexical_index(vectorstore)
+    dedup_index.save(retriver.dedup_index_path, indexed_sources(sources))
+    print(f"Lexical index covers {len(lexical_index.doc_ids)} text and table documents")
+    pruned = get_blob_store().prune({entry['blob'] for entry in sources.values() if 'blob' in entry})
+    if pruned:
+        print(f"Removed {pruned} unreferenced images from the blob store")
+    pruned = prune_derivatives({entry['hash'] for name, entry in sources.items() if name.endswith('.jpg')})
+    if pruned:
+        print(f"Removed {pruned} resized images of sources no longer indexed")
+    if failures:
+        print(f"{len(failures)} images could not be processed or summarized: {', '.join(sorted(failures))}")
+    print(f"Summary cache: {get_summary_cache().stats()}")
+    # Retrying sources that fail again leaves the index as it was, so its version (and the answer cache) stays
+    changed_index = rebuild or checkpoint is not None or writer.documents_written or writer.vectors_deleted
+    manifest = retriver.write_manifest(dict(sorted(sources.items())), previous, bump=bool(changed_index))
+    retriver.clear_checkpoint()
+    print(f"Indexed {len(changed)} new or changed sources ({writer.documents_written} documents), "
+          f"removed {len(removed)} sources ({writer.vectors_deleted} stale vectors) as index version {manifest['version']}")
+    return vectorstore
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the persisted vector index from the data directory.")
+    parser.add_argument("--data", default=retriver.path, help="Directory containing the PDFs and images")
+    parser.add_argument("--force", action="store_true", help="Drop the index and re-process every source")
+    parser.add_argument("--workers", type=int, default=DEFAULT_MAX_WORKERS, help="Processes used to partition PDFs")
+    args = parser.parse_args()
+
+    start = time.time()
+    run_ingestion(args.data, rebuild=args.force, max_workers=args.workers)
+    print(f"Ingestion finished in {time.time() - start:.1f}s")
+    log_snapshot()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import json
+import math
+import os
+import re
+from collections import Counter, defaultdict
+import numpy as np
+
+# Keeps part numbers and specs such as "3-035R-R301" or "0.2 bar" together as single terms
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.,\-/][a-z0-9]+)*")
+SEPARATOR_PATTERN = re.compile(r"[.,\-/]")
+# Question words that match most of the corpus and carry no lexical signal; ignored at query time
+STOPWORDS = frozenset("""
+a an and are as at be by can do does for from how in is it of on or that the this to was what when
+where which who why will with
+""".split())
+
+def tokenize(text):
+    ''' Lowercased terms, with compound terms also indexed by their parts ("3-035r-r301" -> "3", "035r", "r301") '''
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        tokens.append(token)
+        parts = SEPARATOR_PATTERN.split(token)
+        if len(parts) > 1:
+            tokens.extend(part for part in parts if part)
+    return tokens
+
+class LexicalIndex:
+    ''' In-process BM25 inverted index over the original content of text and table documents '''
+
+    def __init__(self, doc_ids, doc_lengths, postings, k1=1.5, b=0.75):
+        self.doc_ids = doc_ids
+        self.doc_lengths = doc_lengths
+        self.postings = postings
+        self.k1 = k1
+        self.b = b
+        self.average_length = (sum(doc_lengths) / len(doc_lengths)) if doc_lengths else 0.0
+        # Per-document length normalization is query independent, so compute it once
+        self.norms = k1 * (1 - b + b * np.asarray(doc_lengths, dtype=np.float32) / (self.average_length or 1.0))
+        count = len(doc_ids)
+        self.idf = {
+            term: math.log(1 + (count - len(entries) + 0.5) / (len(entries) + 0.5))
+            for term, entries in postings.items()
+        }
+        # Per-term BM25 contributions as arrays, computed on a term's first query
+        self._impacts = {}
+
+    @classmethod
+    def build(cls, documents):
+        ''' Build from `(doc_id, text)` pairs '''
+        doc_ids = []
+        doc_lengths = []
+        postings = defaultdict(list)
+        for position, (doc_id, text) in enumerate(documents):
+            terms = Counter(tokenize(text))
+            doc_ids.append(doc_id)
+            doc_lengths.append(sum(terms.values()))
+            for term, frequency in terms.items():
+                postings[term].append((position, frequency))
+        return cls(doc_ids, doc_lengths, dict(postings))
+
+    def _impact(self, term):
+        ''' `(positions, scores)` arrays of the term's BM25 contribution to each document containing it '''
+        impact = self._impacts.get(term)
+        if impact is None:
+            entries = self.postings.get(term)
+            if not entries:
+                return None
+            positions = np.fromiter((position for position, _ in entries), dtype=np.int64, count=len(entries))
+            frequencies = np.fromiter((frequency for _, frequency in entries), dtype=np.float32, count=len(entries))
+            impact = (positions, self.idf[term] * frequencies * (self.k1 + 1) / (frequencies + self.norms[positions]))
+            self._impacts[term] = impact
+        return impact
+
+    def search(self, query, k=10):
+        ''' Top `k` `(doc_id, score)` pairs for the query, best first '''
+        terms = set(tokenize(query))
+        # Queries made only of stopwords still search on them
+        terms = (terms - STOPWORDS) or terms
+        scores = None
+        for term in terms:
+            impact = self._impact(term)
+            if impact is None:
+                continue
+            if scores is None:
+                scores = np.zeros(len(self.doc_ids), dtype=np.float32)
+            positions, contributions = impact
+            scores[positions] += contributions
+        if scores is None or k <= 0:
+            return []
+        matched = np.flatnonzero(scores)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        # Best first, ties in index order
+        best = matched[np.lexsort((matched, -scores[matched]))]
+        return [(self.doc_ids[position], float(scores[position])) for position in best]
+
+    def save(self, path):
+        payload = {
+            'doc_ids': self.doc_ids,
+            'doc_lengths': self.doc_lengths,
+            'postings': self.postings,
+            'k1': self.k1,
+            'b': self.b,
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(payload, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        ''' Load a saved index, or None when there is none '''
+        try:
+            with open(path) as f:
+                payload = json.load(f)
+        except (OSError, ValueError):
+            return None
+        postings = {term: [tuple(entry) for entry in entries] for term, entries in payload['postings'].items()}
+        return cls(payload['doc_ids'], payload['doc_lengths'], postings, payload['k1'], payload['b'])
+
+def reciprocal_rank_fusion(rankings, k=60):
+    ''' Fuse several best-first lists of IDs into one, scoring each ID by sum(1 / (k + rank)) '''
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] += 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
@@ -1,9 +1,117 @@
-from langchain_community.chat_models import ChatOpenAI
 import os
+import threading
 from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
+from governor import estimate_tokens, get_governor
+from telemetry import llm_usage_callback
 load_dotenv()
 
+VISION_MODEL = "gpt-4-vision-preview"
+MAX_COMPLETION_TOKENS = 1024
+# Embedding model of the index; the manifest records it, so changing it makes ingestion rebuild the index
+DEFAULT_EMBEDDING_MODEL = "text-embedding-ada-002"
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", DEFAULT_EMBEDDING_MODEL)
+
+# Keep-alive connection pool shared by every OpenAI client in the process
+MODEL_HTTP_MAX_CONNECTIONS = int(os.getenv("MODEL_HTTP_MAX_CONNECTIONS", "32"))
+MODEL_HTTP_KEEPALIVE = int(os.getenv("MODEL_HTTP_KEEPALIVE", "16"))
+MODEL_HTTP_TIMEOUT = float(os.getenv("MODEL_HTTP_TIMEOUT", "120"))
+
+# Model clients are built once per process and shared by every session and ingestion run
+_clients = {}
+_clients_lock = threading.Lock()
+_http_client = None
+_http_client_lock = threading.Lock()
+
+def use_fake_models():
+    # Deterministic local stand-ins for the OpenAI models, used by the offline benchmarks
+    return os.getenv("RAG_FAKE_MODELS", "0") == "1"
+
+def _shared(name, factory):
+    with _clients_lock:
+        client = _clients.get(name)
+        if client is None:
+            client = _clients[name] = factory()
+    return client
+
+def _http_limits():
+    import httpx
+    return httpx.Limits(max_connections=MODEL_HTTP_MAX_CONNECTIONS, max_keepalive_connections=MODEL_HTTP_KEEPALIVE)
+
+def http_clients():
+    '''
+    `(http_client, http_async_client)` for an OpenAI model. The sync pool is shared by the whole
+    process. Each model gets its own async pool, since async connections belong to the event loop
+    that opened them: a model's async calls must all run in one long-lived loop, the chat app's loop
+    or the background loop that image summarization runs in (`image_processing.background_loop`).
+    '''
+    import httpx
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = httpx.Client(limits=_http_limits(), timeout=MODEL_HTTP_TIMEOUT)
+    return _http_client, httpx.AsyncClient(limits=_http_limits(), timeout=MODEL_HTTP_TIMEOUT)
+
+def _fake_chat():
+    from benchmarks.fake_models import FakeChatModel
+    return FakeChatModel(callbacks=[llm_usage_callback])
+
+def _chat_model(**kwargs):
+    from langchain_openai import ChatOpenAI
+    http_client, http_async_client = http_clients()
+    return ChatOpenAI(model=VISION_MODEL, max_tokens=MAX_COMPLETION_TOKENS, callbacks=[llm_usage_callback],
+                      http_client=http_client, http_async_client=http_async_client, **kwargs)
+
 def get_multimodal_llm():
     # Replace with your actual multimodal LLM configuration (e.g., OpenAI API)
-    model = ChatOpenAI(temperature=0, model="gpt-4-vision-preview", max_tokens=1024)
-    return model
+    if use_fake_models():
+        return _shared("multimodal", _fake_chat)
+    return _shared("multimodal", lambda: _chat_model(temperature=0))
+
+def get_vision_llm():
+    # Image summaries retry on their own, so the client itself must not
+    if use_fake_models():
+        return _shared("vision", _fake_chat)
+    return _shared("vision", lambda: _chat_model(max_retries=0))
+
+def get_answer_llm():
+    if use_fake_models():
+        return _shared("answer", _fake_chat)
+    return _shared("answer", lambda: _chat_model(temperature=0, stream_usage=True))
+
+class GovernedEmbeddings(Embeddings):
+    ''' Embeddings whose requests go through the process-wide model governor '''
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def embed_documents(self, texts):
+        with get_governor().slot(estimate_tokens("".join(texts))):
+            return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        with get_governor().slot(estimate_tokens(text)):
+            return self.embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts):
+        async with get_governor().aslot(estimate_tokens("".join(texts))):
+            return await self.embeddings.aembed_documents(texts)
+
+    async def aembed_query(self, text):
+        async with get_governor().aslot(estimate_tokens(text)):
+            return await self.embeddings.aembed_query(text)
+
+def _openai_embeddings():
+    from langchain_openai import OpenAIEmbeddings
+    http_client, http_async_client = http_clients()
+    return OpenAIEmbeddings(model=EMBEDDING_MODEL, http_client=http_client, http_async_client=http_async_client)
+
+def embedding_model_name():
+    ''' Identifier of the embedding model `get_embeddings` returns '''
+    return "fake-hashing-256" if use_fake_models() else EMBEDDING_MODEL
+
+def get_embeddings():
+    if use_fake_models():
+        from benchmarks.fake_models import HashingEmbeddings
+        return _shared("embeddings", lambda: GovernedEmbeddings(HashingEmbeddings()))
+    return _shared("embeddings", lambda: GovernedEmbeddings(_openai_embeddings()))
@@ -1,34 +1,240 @@
+import itertools
 import os
+import shutil
+import time
 import uuid
-from langchain_community.document_loaders import PyPDFLoader
-from unstructured.partition.pdf import partition_pdf
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from telemetry import observe
 
-def process_pdfs(pdf_directory):
+# Worker processes used for layout inference, and how many pages of a large PDF one task handles
+DEFAULT_MAX_WORKERS = int(os.getenv("PDF_WORKERS", str(os.cpu_count() or 1)))
+PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "20"))
+FIGURES_DIRECTORY = "figures"
+
+def figures_directory(pdf_path):
+    """
+    Directory that receives the images extracted from one PDF.
+
+    Args:
+        pdf_path (str): Path to the PDF file.
+
+    Returns:
+        str: `<pdf directory>/figures/<pdf name without extension>`.
+    """
+
+    pdf_directory, pdf_file = os.path.split(pdf_path)
+    return os.path.join(pdf_directory, FIGURES_DIRECTORY, os.path.splitext(pdf_file)[0])
+
+def partition_pdf_file(pdf_path, image_output_dir=None, starting_page_number=1):
+    """
+    Partitions a single PDF into chunked text, table and image elements.
+
+    Args:
+        pdf_path (str): Path to the PDF file.
+        image_output_dir (str, optional): Where extracted images are written.
+        starting_page_number (int, optional): Page number of the first page in the file.
+
+    Returns:
+        list: The elements extracted from the PDF.
+    """
+
+    # Imported here: layout inference pulls in heavy dependencies only the workers need
+    from unstructured.partition.pdf import partition_pdf
+
+    return partition_pdf(
+        filename=pdf_path,
+        extract_images_in_pdf=True,
+        infer_table_structure=True,
+        chunking_strategy="by_title",
+        max_characters=4000,
+        new_after_n_chars=3800,
+        combine_text_under_n_chars=2000,
+        starting_page_number=starting_page_number,
+        image_output_dir_path=image_output_dir or figures_directory(pdf_path)
+    )
+
+def plan_page_ranges(pdf_path, pages_per_task=PAGES_PER_TASK):
+    """
+    Splits a PDF into page ranges that can be partitioned independently.
+
+    Args:
+        pdf_path (str): Path to the PDF file.
+        pages_per_task (int): Maximum number of pages per range.
+
+    Returns:
+        list: `(start, end)` zero-based, end-exclusive page ranges, or `[None]` for the whole file.
+    """
+
+    from pypdf import PdfReader
+
+    try:
+        page_count = len(PdfReader(pdf_path).pages)
+    except Exception:
+        # Let the partitioning task report the real error for unreadable files
+        return [None]
+    if page_count <= pages_per_task:
+        return [None]
+    return [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+
+def _partition_task(pdf_path, page_range, image_output_dir):
+    """
+    Worker entry point: partitions one PDF or one page range of it.
+
+    Args:
+        pdf_path (str): Path to the PDF file.
+        page_range (tuple): `(start, end)` pages to partition, or None for the whole file.
+        image_output_dir (str): Directory owned by this task for extracted images.
+
+    Returns:
+        tuple: `(elements, None, seconds)` on success, `(None, error message, seconds)` on failure.
+    """
+
+    start = time.perf_counter()
+    elements, error = _partition(pdf_path, page_range, image_output_dir)
+    return elements, error, time.perf_counter() - start
+
+def _partition(pdf_path, page_range, image_output_dir):
+    os.makedirs(image_output_dir, exist_ok=True)
+    try:
+        if page_range is None:
+            return partition_pdf_file(pdf_path, image_output_dir), None
+
+        from pypdf import PdfReader, PdfWriter
+
+        start, end = page_range
+        reader = PdfReader(pdf_path)
+        writer = PdfWriter()
+        for page in reader.pages[start:end]:
+            writer.add_page(page)
+        part_path = os.path.join(image_output_dir, f"pages-{uuid.uuid4().hex}.pdf")
+        with open(part_path, "wb") as f:
+            writer.write(f)
+        try:
+            return partition_pdf_file(part_path, image_output_dir, starting_page_number=start + 1), None
+        finally:
+            os.remove(part_path)
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+def _plan(pdf_path, pages_per_task):
+    # Each task writes its images to its own subdirectory of the PDF's figures directory
+    image_root = figures_directory(pdf_path)
+    shutil.rmtree(image_root, ignore_errors=True)
+    tasks = []
+    for page_range in plan_page_ranges(pdf_path, pages_per_task):
+        name = "all" if page_range is None else f"pages-{page_range[0] + 1:04d}-{page_range[1]:04d}"
+        tasks.append((pdf_path, page_range, os.path.join(image_root, name)))
+    return pdf_path, tasks
+
+def partition_pdfs(pdf_paths, max_workers=DEFAULT_MAX_WORKERS, pages_per_task=PAGES_PER_TASK, max_pending=None):
+    """
+    Partitions PDFs across a process pool, splitting large files into page ranges.
+
+    Args:
+        pdf_paths (list): Paths of the PDFs to partition.
+        max_workers (int): Number of worker processes; 1 partitions in-process.
+        pages_per_task (int): Maximum number of pages handled by one task.
+        max_pending (int, optional): PDFs submitted ahead of the consumer, so results never pile up
+            in memory; defaults to twice the number of workers.
+
+    Yields:
+        tuple: `(pdf_path, elements, error)` in the order of `pdf_paths`. `elements` is None when
+        any part of the file failed, including a worker process dying on it, and `error` then
+        describes the failure.
+    """
+
+    plans = (_plan(pdf_path, pages_per_task) for pdf_path in pdf_paths)
+    if max_workers <= 1:
+        for pdf_path, tasks in plans:
+            yield _collect(pdf_path, [_partition_task(*task) for task in tasks])
+        return
+
+    executor = ProcessPoolExecutor(max_workers=max_workers)
+
+    def submit(plan):
+        pdf_path, tasks = plan
+        try:
+            return plan, [executor.submit(_partition_task, *task) for task in tasks]
+        except BrokenProcessPool:
+            # The pool broke since the last submission; collecting the file reports it
+            return plan, None
+
+    def restart():
+        nonlocal executor
+        executor.shutdown(wait=False, cancel_futures=True)
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+
+    def isolated(plan):
+        # Alone in the pool, a file that kills a worker is the one that crashed it
+        pdf_path, tasks = plan
+        for _, _, image_output_dir in tasks:
+            shutil.rmtree(image_output_dir, ignore_errors=True)
+        try:
+            return _collect(pdf_path, [future.result() for future in submit(plan)[1]])
+        except BrokenProcessPool:
+            restart()
+            error = "BrokenProcessPool: a partitioning worker died (crash or out of memory)"
+            print(f"Failed to partition {pdf_path}: {error}")
+            return pdf_path, None, error
+
+    try:
+        pending = deque(submit(plan) for plan in itertools.islice(plans, max_pending or 2 * max_workers))
+        while pending:
+            plan, file_futures = pending.popleft()
+            try:
+                if file_futures is None:
+                    raise BrokenProcessPool()
+                result = _collect(plan[0], [future.result() for future in file_futures])
+            except BrokenProcessPool:
+                # A worker died (a crash in the native PDF or OCR stack, or the OOM killer) and every
+                # file in flight lost its results: retry them one at a time in a new pool
+                restart()
+                suspects = [plan] + [suspect for suspect, _ in pending]
+                pending.clear()
+                for suspect in suspects:
+                    yield isolated(suspect)
+                pending.extend(submit(plan) for plan in itertools.islice(plans, max_pending or 2 * max_workers))
+                continue
+            # Keep the workers busy while the consumer handles this file
+            plan = next(plans, None)
+            if plan is not None:
+                pending.append(submit(plan))
+            yield result
+    finally:
+        executor.shutdown()
+
+def _collect(pdf_path, results):
+    elements = []
+    for part_elements, error, seconds in results:
+        # Worker timings are reported back to the parent, which owns the metrics
+        observe("ingest.partition_pdf", seconds)
+        if error is not None:
+            print(f"Failed to partition {pdf_path}: {error}")
+            return pdf_path, None, error
+        elements.extend(part_elements or [])
+    return pdf_path, elements, None
+
+def process_pdfs(pdf_directory, pdf_files=None, max_workers=DEFAULT_MAX_WORKERS):
     """
     Processes all PDFs in a directory, extracting elements and saving summaries.
 
     Args:
         pdf_directory (str): Path to the directory containing PDFs.
+        pdf_files (list, optional): Only process these file names from the directory.
+        max_workers (int, optional): Number of worker processes used for partitioning.
 
     Returns:
         list: A list of dictionaries containing extracted elements and summaries.
     """
 
-    pdf_files = [f for f in os.listdir(pdf_directory) if f.endswith('.pdf')]
+    if pdf_files is None:
+        pdf_files = sorted(f for f in os.listdir(pdf_directory) if f.endswith('.pdf'))
     all_elements = []
 
-    for pdf_file in pdf_files:
-        pdf_path = os.path.join(pdf_directory, pdf_file)
-        extracted_elements = partition_pdf(
-            filename=pdf_path,
-            extract_images_in_pdf=True,
-            infer_table_structure=True,
-            chunking_strategy="by_title",
-            max_characters=4000,
-            new_after_n_chars=3800,
-            combine_text_under_n_chars=2000,
-            image_output_dir_path= os.path.join(os.getcwd(), "Data")  # Assuming images are saved in the same directory
-        )
+    pdf_paths = [os.path.join(pdf_directory, pdf_file) for pdf_file in pdf_files]
+    for _, extracted_elements, _ in partition_pdfs(pdf_paths, max_workers):
         if extracted_elements:
             all_elements.extend(extracted_elements)
 
@@ -48,5 +254,3 @@ def process_pdfs(pdf_directory):
 #         elif "unstructured.documents.elements.CompositeElement" in str(type(element)):
 #             texts.append(str(element))
 #     return tables, texts
-
-
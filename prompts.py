@@ -0,0 +1,20 @@
+# Prompts bundled with the app, so nothing has to be pulled from the LangChain hub at runtime.
+# Changing the summary prompts changes their cache keys, so existing summaries are regenerated.
+
+# Prompt for text and table summaries
+summary_prompt = """You are an assistant tasked with summarizing tables and text. \
+Give a concise summary of the table or text. Table or text chunk: {element} """
+
+# Prompt for image summaries
+image_summary_prompt = """You are an assistant tasked with summarizing images for retrieval. \
+These summaries will be embedded and used to retrieve the raw image. \
+Give a concise summary of the image that is well optimized for retrieval. \
+Describe the image in detail. Be specific about graphs, such as bar plots, curves."""
+
+# Prompt template for the answer chain
+answer_template = """
+Answer the question based only on the following context, which can include text, images, and tables:
+{context}
+Question: {question} 
+"""
+
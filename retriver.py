@@ -1,131 +1,366 @@
 from langchain_community.vectorstores import Chroma
-from langchain.storage import InMemoryStore
-from langchain.retrievers.multi_vector import MultiVectorRetriever
-from langchain_community.embeddings import OpenAIEmbeddings
-import uuid
-from typing import List
-from langchain.schema.document import Document
-from process_pdfs import process_pdfs
+import hashlib
+import json
+from html.parser import HTMLParser
+import time
+from langchain_core.documents import Document
 from langchain_core.prompts import ChatPromptTemplate
-from llms import get_multimodal_llm
-from langchain.schema import StrOutputParser
-from langchain import hub
-from image_processing import encode_image, resize_image, plt_img_base64, process_images
+from langchain_core.output_parsers import StrOutputParser
+from summary_cache import cached_batch, model_name
+from lexical_index import LexicalIndex, reciprocal_rank_fusion
+from telemetry import span, timed
+from governor import governed
+from llms import DEFAULT_EMBEDDING_MODEL, MAX_COMPLETION_TOKENS, embedding_model_name, get_embeddings
 from dotenv import load_dotenv
 import os
 load_dotenv()
 
-def create_documents_and_vectorstore(texts, text_summaries, tables, table_summaries, img_base64_list, image_summaries):
+# Persisted index location and the manifest describing what it was built from
+current_working_directory = os.getcwd()
+path = os.path.join(current_working_directory, 'Data')
+persist_directory = "./chroma_db"
+manifest_path = os.path.join(persist_directory, "manifest.json")
+lexical_index_path = os.path.join(persist_directory, "bm25.json")
+dedup_index_path = os.path.join(persist_directory, "dedup.json")
+# Sources written so far by an ingestion run that has not finished yet
+checkpoint_path = os.path.join(persist_directory, "checkpoint.json")
+
+# Bump when the document layout in the vector store changes so old indexes get rebuilt
+INDEX_SCHEMA_VERSION = 7
+
+# Vector store backend: "chroma", or "flat" for the memory-mapped NumPy index in flat_index.py
+VECTOR_STORE = os.getenv("VECTOR_STORE", "chroma")
+# Storage precision of the flat index: "float16" or "int8"
+VECTOR_STORE_DTYPE = os.getenv("VECTOR_STORE_DTYPE", "float16")
+# Documents embedded and written per vector store call
+UPSERT_BATCH_SIZE = int(os.getenv("INGEST_UPSERT_BATCH", "256"))
+SOURCE_EXTENSIONS = ('.pdf', '.jpg')
+
+def document_id(source, source_hash, kind, position, content):
+    '''
+    Stable vector ID derived from the source file's path and contents, the element's position in it
+    and its content. The path keeps byte-identical files, such as a logo extracted on every page, apart.
+    '''
+    content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    return hashlib.sha256(f"{source}:{source_hash}:{kind}:{position}:{content_hash}".encode('utf-8')).hexdigest()[:40]
+
+def create_documents(source, source_hash, texts, text_summaries, tables, table_summaries, image_hashes, image_summaries):
     documents = []
-    retrieve_contents = []
+    ids = []
 
-    for e, s in zip(texts, text_summaries):
-        i = str(uuid.uuid4())
+    for position, (e, s) in enumerate(zip(texts, text_summaries)):
+        i = document_id(source, source_hash, 'text', position, e)
         doc = Document(
             page_content=s,
             metadata={
                 'id': i,
                 'type': 'text',
+                'source': source,
                 'original_content': e
             }
         )
-        retrieve_contents.append((i, e))
+        ids.append(i)
         documents.append(doc)
-    
-    for e, s in zip(tables, table_summaries):
-        i = str(uuid.uuid4())
+
+    for position, (e, s) in enumerate(zip(tables, table_summaries)):
+        i = document_id(source, source_hash, 'table', position, e)
         doc = Document(
             page_content=s,
             metadata={
                 'id': i,
                 'type': 'table',
+                'source': source,
                 'original_content': e
             }
         )
-        retrieve_contents.append((i, e))
+        ids.append(i)
         documents.append(doc)
-    
-    for e, s in zip(img_base64_list, image_summaries):
-        i = str(uuid.uuid4())
+
+    for position, (e, s) in enumerate(zip(image_hashes, image_summaries)):
+        # The image itself lives in the blob store, the vector metadata only carries its hash
+        i = document_id(source, source_hash, 'image', position, e)
         doc = Document(
             page_content=s,
             metadata={
                 'id': i,
                 'type': 'image',
-                'original_content': e
+                'source': source,
+                'image_hash': e
             }
         )
-        retrieve_contents.append((i, s))
+        ids.append(i)
         documents.append(doc)
 
-    if documents:
-        vectorstore = Chroma.from_documents(documents=documents, embedding=OpenAIEmbeddings(), persist_directory="./chroma_db")
-    else:
-        vectorstore = Chroma(embedding_function=OpenAIEmbeddings(), persist_directory="./chroma_db")
-    
+    return documents, ids
+
+@timed("ingest.upsert")
+def create_documents_and_vectorstore(documents, ids, stale_ids=(), backend=None, vectorstore=None):
+    ''' Apply one ingestion diff: upsert the new documents in batches, then drop vectors that are no longer produced '''
+    vectorstore = vectorstore or open_vectorstore(backend)
+    for start in range(0, len(documents), UPSERT_BATCH_SIZE):
+        vectorstore.add_documents(documents[start:start + UPSERT_BATCH_SIZE], ids=ids[start:start + UPSERT_BATCH_SIZE])
+    if stale_ids:
+        vectorstore.delete(ids=list(stale_ids))
     return vectorstore
 
-# Call the function:
-# populate_retriever(retriever2, texts, text_summaries, tables, table_summaries, img_base64_list, image_summaries)
+def vector_store_name(backend=None):
+    ''' Backend and storage format recorded in the manifest, e.g. "chroma" or "flat-int8" '''
+    backend = backend or VECTOR_STORE
+    return backend if backend == "chroma" else f"{backend}-{VECTOR_STORE_DTYPE}"
 
-rag_prompt_mistral = hub.pull("rlm/rag-prompt-mistral")
-# Specify the directory containing the PDFs
-current_working_directory = os.getcwd()
-path = os.path.join(current_working_directory, 'Data')
-# Separate tables and text elements
-raw_pdf_elements = process_pdfs(path)
+def index_layout():
+    ''' What vectors written earlier must have been built with to be reused: schema, backend and embedding model '''
+    return {'schema': INDEX_SCHEMA_VERSION, 'vector_store': vector_store_name(), 'embedding_model': embedding_model_name()}
+
+def matches_layout(recorded):
+    ''' True when a manifest or checkpoint was written for the current `index_layout` '''
+    # Indexes from before these fields were recorded used Chroma and the default embedding model
+    recorded = dict({'vector_store': 'chroma', 'embedding_model': DEFAULT_EMBEDDING_MODEL}, **recorded)
+    return all(recorded.get(key) == value for key, value in index_layout().items())
+
+def open_vectorstore(backend=None):
+    ''' Open the persisted index of the configured backend without touching its contents '''
+    backend = backend or VECTOR_STORE
+    if backend == "flat":
+        from flat_index import FlatVectorStore
+        return FlatVectorStore(get_embeddings(), persist_directory, VECTOR_STORE_DTYPE)
+    if backend != "chroma":
+        raise ValueError(f"Unknown vector store backend {backend!r}, expected 'chroma' or 'flat'")
+    return Chroma(embedding_function=get_embeddings(), persist_directory=persist_directory)
+
+@timed("ingest.lexical_index")
+def build_lexical_index(vectorstore):
+    ''' BM25 index over the original content of every text and table document in the store '''
+    stored = vectorstore.get(where={'type': {'$in': ['text', 'table']}}, include=['metadatas'])
+    index = LexicalIndex.build((i, m['original_content']) for i, m in zip(stored['ids'], stored['metadatas']))
+    os.makedirs(persist_directory, exist_ok=True)
+    index.save(lexical_index_path)
+    return index
+
+class HybridRetriever:
+    ''' Vector search fused with BM25 lexical search by reciprocal rank fusion '''
 
-def tex_tab_elements():
+    def __init__(self, vectorstore, lexical_index=None, rrf_k=60):
+        self.vectorstore = vectorstore
+        self.lexical_index = lexical_index
+        self.rrf_k = rrf_k
+
+    def similarity_search(self, query, k=4):
+        with span("retrieve.embed_query"):
+            vector = self.vectorstore.embeddings.embed_query(query)
+        return self.similarity_search_with_vector(query, vector, k)
+
+    def similarity_search_with_vector(self, query, vector, k=4):
+        ''' Same as `similarity_search`, for callers that already embedded the query '''
+        with span("retrieve.vector_search"):
+            vector_docs = self.vectorstore.similarity_search_by_vector(vector, k=k * 2)
+        if self.lexical_index is None:
+            return vector_docs[:k]
+        with span("retrieve.lexical_search"):
+            lexical_ids = [doc_id for doc_id, _ in self.lexical_index.search(query, k * 2)]
+
+        docs = {d.metadata['id']: d for d in vector_docs}
+        ranked = reciprocal_rank_fusion([list(docs), lexical_ids], self.rrf_k)[:k]
+        missing = [doc_id for doc_id in ranked if doc_id not in docs]
+        if missing:
+            with span("retrieve.fetch_lexical_hits"):
+                stored = self.vectorstore.get(ids=missing, include=['documents', 'metadatas'])
+            for doc_id, content, metadata in zip(stored['ids'], stored['documents'], stored['metadatas']):
+                docs[doc_id] = Document(page_content=content, metadata=metadata)
+        return [docs[doc_id] for doc_id in ranked if doc_id in docs]
+
+class TableRowParser(HTMLParser):
+    ''' Cell texts of each `<tr>` in an HTML table '''
+
+    def __init__(self):
+        super().__init__()
+        self.rows = []
+        self._row = None
+        self._cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'tr':
+            self._row = []
+        elif tag in ('td', 'th') and self._row is not None:
+            self._cell = []
+
+    def handle_endtag(self, tag):
+        if tag in ('td', 'th') and self._cell is not None:
+            self._row.append(" ".join("".join(self._cell).split()))
+            self._cell = None
+        elif tag == 'tr' and self._row is not None:
+            if any(self._row):
+                self.rows.append(self._row)
+            self._row = None
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell.append(data)
+
+def table_text(element):
+    '''
+    A table as one line per row with " | " between cells, taken from the inferred table structure.
+    `str(element)` flattens all cells into one run of text, which loses the rows.
+    '''
+    html = getattr(getattr(element, 'metadata', None), 'text_as_html', None)
+    if html:
+        parser = TableRowParser()
+        parser.feed(html)
+        if parser.rows:
+            return "\n".join(" | ".join(row) for row in parser.rows)
+    return str(element)
+
+def tex_tab_elements(raw_pdf_elements):
     tables = []
     texts = []
     for element in raw_pdf_elements:
         if "unstructured.documents.elements.Table" in str(type(element)):
-            tables.append(str(element))
+            tables.append(table_text(element))
         elif "unstructured.documents.elements.CompositeElement" in str(type(element)):
             texts.append(str(element))
     return tables, texts
 # Function to create summarization chain
 def create_summarization_chain(prompt_text, llm):
     prompt = ChatPromptTemplate.from_template(prompt_text)
-    model = llm
+    model = governed(llm, MAX_COMPLETION_TOKENS)
     return {"element": lambda x: x} | prompt | model | StrOutputParser()
 
 # Function to summarize text data
+@timed("ingest.summarize_texts")
 def text_summaries(texts, prompt_text, llm):
     summarization_chain = create_summarization_chain(prompt_text, llm)
-    return summarization_chain.batch(texts, {"max_concurrency": 5})
+    return cached_batch(summarization_chain, texts, prompt_text, model_name(llm), {"max_concurrency": 5})
 
 # Function to summarize table data
+@timed("ingest.summarize_tables")
 def table_summaries(tables, prompt_text, llm):
     summarization_chain = create_summarization_chain(prompt_text, llm)
-    return summarization_chain.batch(tables, {"max_concurrency": 5})
+    return cached_batch(summarization_chain, tables, prompt_text, model_name(llm), {"max_concurrency": 5})
+
+def file_sha256(file_path):
+    ''' Hash a file's contents in chunks '''
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def list_sources(data_path, extensions=SOURCE_EXTENSIONS):
+    ''' Paths, relative to the data directory, of every ingestible file including extracted figures '''
+    names = []
+    for root, _, files in os.walk(data_path):
+        for name in files:
+            if name.endswith(extensions):
+                names.append(os.path.relpath(os.path.join(root, name), data_path))
+    return sorted(names)
+
+def source_stats(data_path, extensions=SOURCE_EXTENSIONS, known=None):
+    '''
+    Map every ingestible file in the data directory to its content hash, size and mtime. Files whose
+    size and mtime match their entry in `known` (e.g. the manifest's sources) keep the recorded hash
+    instead of being read again.
+    '''
+    known = known or {}
+    stats = {}
+    for name in list_sources(data_path, extensions):
+        file_path = os.path.join(data_path, name)
+        stat = os.stat(file_path)
+        entry = known.get(name, {})
+        if 'hash' in entry and (entry.get('size'), entry.get('mtime_ns')) == (stat.st_size, stat.st_mtime_ns):
+            digest = entry['hash']
+        else:
+            digest = file_sha256(file_path)
+        stats[name] = {'hash': digest, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    return stats
 
-# Initialize path, prompt, and LLM
-prompt_text = """You are an assistant tasked with summarizing tables and text. \
-Give a concise summary of the table or text. Table or text chunk: {element} """
-#llm = getLLM_SauerkrautLM()
-llm = get_multimodal_llm()
+def scan_sources(data_path, extensions=SOURCE_EXTENSIONS, known=None):
+    ''' Map every ingestible file in the data directory to its content hash '''
+    return {name: stat['hash'] for name, stat in source_stats(data_path, extensions, known).items()}
 
-# Load table and text data
-tables, texts = tex_tab_elements()
+def load_manifest():
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
-# Summarize the text and table data
-text_summaries = text_summaries(texts, prompt_text, llm)
-table_summaries = table_summaries(tables, prompt_text, llm)
+def write_manifest(sources, previous=None, bump=True):
+    ''' Record what the persisted index was built from, bumping its version unless only file stats changed '''
+    manifest = {
+        **index_layout(),
+        'version': (previous or {}).get('version', 0) + (1 if bump else 0),
+        'built_at': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        'sources': sources,
+    }
+    os.makedirs(persist_directory, exist_ok=True)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+    return manifest
 
-# Prompt
-prompt = """You are an assistant tasked with summarizing images for retrieval. \
-These summaries will be embedded and used to retrieve the raw image. \
-Give a concise summary of the image that is well optimized for retrieval. \
-Describe the image in detail. Be specific about graphs, such as bar plots, curves."""
+def load_checkpoint():
+    ''' Sources already written by an interrupted ingestion run into the current index layout, or None '''
+    try:
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not matches_layout(checkpoint):
+        return None
+    return checkpoint
 
-img_base64_list, image_summaries = process_images(path, prompt)
+def write_checkpoint(sources, dedup=None):
+    ''' Record the sources written so far, with the near-duplicate index entries of exactly those sources '''
+    os.makedirs(persist_directory, exist_ok=True)
+    tmp_path = checkpoint_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({**index_layout(), 'sources': sources, 'dedup': dedup or {}}, f)
+    os.replace(tmp_path, checkpoint_path)
 
+def clear_checkpoint():
+    try:
+        os.remove(checkpoint_path)
+    except FileNotFoundError:
+        pass
 
+_index_version = (None, None)
+
+def current_index_version():
+    ''' Version of the persisted index, re-reading the manifest only when the file changes '''
+    global _index_version
+    try:
+        mtime = os.stat(manifest_path).st_mtime_ns
+    except OSError:
+        return None
+    if _index_version[0] != mtime:
+        manifest = load_manifest()
+        _index_version = (mtime, manifest.get('version') if manifest else None)
+    return _index_version[1]
+
+def manifest_is_current(data_path=path):
+    '''
+    True when the persisted index was built by this schema, backend and embedding model from the
+    current data files. Only files whose size or mtime differ from the manifest are hashed. Sources
+    that failed to ingest are recorded with their hash, so they only count as stale once the file changes.
+    '''
+    manifest = load_manifest()
+    if manifest is None or not matches_layout(manifest) or os.path.exists(checkpoint_path):
+        return False
+    sources = manifest.get('sources', {})
+    indexed = {name: entry['hash'] for name, entry in sources.items()}
+    return indexed == scan_sources(data_path, known=sources)
+
+def load_retriever_instance(data_path=path):
+    # Serving opens the index built by `python ingest.py`; only rebuild when it is missing or stale
+    if not manifest_is_current(data_path):
+        print("Vector index is missing or out of date, running ingestion...")
+        from ingest import run_ingestion
+        vectorstore = run_ingestion(data_path)
+    else:
+        vectorstore = open_vectorstore()
+    return HybridRetriever(vectorstore, LexicalIndex.load(lexical_index_path))
 
-def load_retriever_instance():
-    retriever_instance = create_documents_and_vectorstore( 
-                                        texts, text_summaries, 
-                                        tables, table_summaries, 
-                                        img_base64_list, image_summaries)
-    return retriever_instance 
+def open_retriever():
+    ''' Reopen the persisted index as it is now, e.g. after an ingestion run published a new version '''
+    return HybridRetriever(open_vectorstore(), LexicalIndex.load(lexical_index_path))
@@ -0,0 +1,165 @@
+import atexit
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+# On-disk cache of LLM summaries so re-ingesting unchanged content costs no LLM calls
+cache_path = os.path.join(os.getcwd(), "cache", "summaries.sqlite")
+DEFAULT_MAX_ENTRIES = int(os.getenv("SUMMARY_CACHE_MAX_ENTRIES", "50000"))
+
+def make_key(content, prompt, model):
+    ''' Cache key from the element text or image bytes, the prompt text and the model name '''
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    digest = hashlib.sha256()
+    for part in (hashlib.sha256(content).digest(), prompt.encode('utf-8'), str(model).encode('utf-8')):
+        digest.update(len(part).to_bytes(8, 'big'))
+        digest.update(part)
+    return digest.hexdigest()
+
+def model_name(llm):
+    ''' Best-effort model identifier of a LangChain chat model '''
+    return getattr(llm, 'model_name', None) or getattr(llm, 'model', None) or type(llm).__name__
+
+# Eviction trims the cache this far below its bound, so it runs once per many inserts
+EVICTION_HEADROOM = 0.1
+# Hits whose `last_used` is written in one transaction; the LRU order only needs to be roughly current
+TOUCH_BATCH = 256
+# Bound on the keys per SELECT, below SQLite's parameter limit
+QUERY_BATCH = 500
+
+class SummaryCache:
+    '''
+    SQLite-backed summary cache with size-bounded LRU eviction and hit/miss counters. Hits only
+    record their `last_used` time in memory and write it in batches, and the row count is kept
+    running, so a warm re-run costs no write transaction per element.
+    '''
+
+    def __init__(self, path=cache_path, max_entries=DEFAULT_MAX_ENTRIES):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._touched = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS summaries ("
+            "key TEXT PRIMARY KEY, summary TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS summaries_last_used ON summaries (last_used)")
+        self._conn.commit()
+        (self._count,) = self._conn.execute("SELECT COUNT(*) FROM summaries").fetchone()
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        ''' Cached summaries of `keys` in order, None where there is none '''
+        with self._lock:
+            found = {}
+            unique = list(dict.fromkeys(keys))
+            for start in range(0, len(unique), QUERY_BATCH):
+                chunk = unique[start:start + QUERY_BATCH]
+                found.update(self._conn.execute(
+                    f"SELECT key, summary FROM summaries WHERE key IN ({', '.join('?' * len(chunk))})", chunk))
+            now = time.time()
+            results = []
+            for key in keys:
+                summary = found.get(key)
+                if summary is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    self._touched[key] = now
+                results.append(summary)
+            if len(self._touched) >= TOUCH_BATCH:
+                self._write_touched()
+                self._conn.commit()
+            return results
+
+    def put(self, key, summary):
+        self.put_many([(key, summary)])
+
+    def put_many(self, items):
+        ''' Store `(key, summary)` pairs in one transaction '''
+        with self._lock:
+            now = time.time()
+            for key, summary in items:
+                inserted = self._conn.execute(
+                    "INSERT OR IGNORE INTO summaries (key, summary, last_used) VALUES (?, ?, ?)", (key, summary, now),
+                ).rowcount
+                if inserted:
+                    self._count += 1
+                else:
+                    self._conn.execute(
+                        "UPDATE summaries SET summary = ?, last_used = ? WHERE key = ?", (summary, now, key))
+                self._touched.pop(key, None)
+            self._write_touched()
+            self._evict()
+            self._conn.commit()
+
+    def flush(self):
+        ''' Write the `last_used` times of recent hits '''
+        with self._lock:
+            self._write_touched()
+            self._conn.commit()
+
+    def _write_touched(self):
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE summaries SET last_used = ? WHERE key = ?", [(t, key) for key, t in self._touched.items()])
+            self._touched = {}
+
+    def _evict(self):
+        if self._count <= self.max_entries:
+            return
+        # Other processes may share the file, so the running count is corrected before evicting
+        (self._count,) = self._conn.execute("SELECT COUNT(*) FROM summaries").fetchone()
+        if self._count > self.max_entries:
+            excess = self._count - int(self.max_entries * (1 - EVICTION_HEADROOM))
+            self._conn.execute(
+                "DELETE FROM summaries WHERE key IN "
+                "(SELECT key FROM summaries ORDER BY last_used ASC LIMIT ?)",
+                (excess,),
+            )
+            self._count -= excess
+
+    def stats(self):
+        self.flush()
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM summaries").fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': count}
+
+_summary_cache = None
+_summary_cache_lock = threading.Lock()
+
+def get_summary_cache():
+    ''' Process-wide summary cache, opened on first use '''
+    global _summary_cache
+    with _summary_cache_lock:
+        if _summary_cache is None:
+            _summary_cache = SummaryCache()
+            # Hits since the last batched write keep their recency
+            atexit.register(_summary_cache.flush)
+        return _summary_cache
+
+def cached_batch(chain, items, prompt, model, config=None):
+    ''' Run `chain.batch` only for the items whose summary is not cached yet, returning results in input order '''
+    cache = get_summary_cache()
+    keys = [make_key(item, prompt, model) for item in items]
+    results = cache.get_many(keys)
+
+    # Identical items in the same batch only need one call
+    pending = {}
+    for key, item, result in zip(keys, items, results):
+        if result is None and key not in pending:
+            pending[key] = item
+    if pending:
+        summaries = dict(zip(pending, chain.batch(list(pending.values()), config)))
+        cache.put_many(summaries.items())
+        results = [summaries[key] if result is None else result for key, result in zip(keys, results)]
+    return results
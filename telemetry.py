@@ -0,0 +1,169 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+# Stage timings and LLM usage counters, exposed in Prometheus text format and as structured logs.
+# RAG_METRICS=0 turns every span and counter into a no-op; RAG_METRICS_LOG=1 logs one JSON line per span.
+ENABLED = os.getenv("RAG_METRICS", "1") != "0"
+LOG_SPANS = os.getenv("RAG_METRICS_LOG", "0") == "1"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+logger = logging.getLogger("rag.metrics")
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+def observe(stage, seconds):
+    ''' Record one duration for a pipeline stage '''
+    if not ENABLED:
+        return
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = {'count': 0, 'sum': 0.0, 'buckets': [0] * len(BUCKETS)}
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+                break
+    if LOG_SPANS:
+        logger.info(json.dumps({'stage': stage, 'seconds': round(seconds, 6)}))
+
+def incr(name, value=1, **labels):
+    ''' Add to a counter such as `llm_calls_total{model="..."}` '''
+    if not ENABLED:
+        return
+    key = (name, _labels_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+@contextmanager
+def span(stage):
+    ''' Time the enclosed block as one observation of `stage` '''
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+def timed(stage):
+    ''' Decorator timing every call of a function, sync or async, as `stage` '''
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def snapshot():
+    ''' Current metrics as a JSON-serializable dict '''
+    with _lock:
+        return {
+            'stages': {
+                stage: {'count': h['count'], 'sum_seconds': h['sum'],
+                        'mean_seconds': h['sum'] / h['count'] if h['count'] else 0.0}
+                for stage, h in sorted(_histograms.items())
+            },
+            'counters': [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(_counters.items())
+            ],
+        }
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+def render_prometheus():
+    ''' Metrics in the Prometheus text exposition format '''
+    lines = [
+        "# HELP rag_stage_seconds Time spent in each ingestion and answer pipeline stage.",
+        "# TYPE rag_stage_seconds histogram",
+    ]
+    with _lock:
+        for stage, histogram in sorted(_histograms.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram['buckets']):
+                cumulative += count
+                lines.append(f'rag_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'rag_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+            lines.append(f'rag_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]}')
+            lines.append(f'rag_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+        names = sorted({name for name, _ in _counters})
+        for name in names:
+            lines.append(f"# TYPE rag_{name} counter")
+            for (counter_name, labels), value in sorted(_counters.items()):
+                if counter_name == name:
+                    lines.append(f"rag_{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+def log_snapshot(prefix="Metrics"):
+    ''' Print the current metrics as one structured JSON line '''
+    if ENABLED:
+        print(f"{prefix}: {json.dumps(snapshot())}")
+
+class LLMUsageCallback(BaseCallbackHandler):
+    ''' Counts LLM calls and tokens for every model it is attached to '''
+
+    def __init__(self):
+        self._models = {}
+
+    def on_chat_model_start(self, serialized, messages, run_id=None, invocation_params=None, **kwargs):
+        params = invocation_params or {}
+        self._models[run_id] = params.get('model_name') or params.get('model') or params.get('_type') or 'unknown'
+
+    def on_llm_error(self, error, run_id=None, **kwargs):
+        self._models.pop(run_id, None)
+        incr("llm_errors_total")
+
+    def on_llm_end(self, response, run_id=None, **kwargs):
+        usage = (response.llm_output or {}).get('token_usage') or {}
+        model = self._models.pop(run_id, None) or (response.llm_output or {}).get('model_name') or 'unknown'
+        if not usage:
+            # Streaming responses carry usage on the message instead
+            for generations in response.generations:
+                for generation in generations:
+                    metadata = getattr(getattr(generation, 'message', None), 'usage_metadata', None) or {}
+                    usage = {
+                        'prompt_tokens': usage.get('prompt_tokens', 0) + metadata.get('input_tokens', 0),
+                        'completion_tokens': usage.get('completion_tokens', 0) + metadata.get('output_tokens', 0),
+                    }
+        incr("llm_calls_total", model=model)
+        incr("llm_tokens_total", usage.get('prompt_tokens', 0), model=model, kind="prompt")
+        incr("llm_tokens_total", usage.get('completion_tokens', 0), model=model, kind="completion")
+
+llm_usage_callback = LLMUsageCallback()
+
+def mount_metrics_endpoint(app, path="/metrics"):
+    ''' Serve `render_prometheus()` from a FastAPI app, ahead of any catch-all route '''
+    from fastapi.responses import PlainTextResponse
+
+    async def metrics():
+        return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
+
+    app.add_api_route(path, metrics, methods=["GET"], include_in_schema=False)
+    app.router.routes.insert(0, app.router.routes.pop())